@@ -48,8 +48,8 @@ btn4.align(btn3, lv.ALIGN.OUT_RIGHT_TOP, 10, 0)
 lv.scr_load(scr)
 
 # ButtonEncoder
-# step set at 5. Try with 7-10 to see how long one has to press (loooooonger)
-enc = M5ButtonEncoder(step = 5, debug = True)
+# One move when A/C is pressed, then 5 moves per second after half a second. Play with delay and rate.
+enc = M5ButtonEncoder(delay = 500, rate = 5, debug = True)
 
 # register the device driver:
 enc.registerDriver()
@@ -0,0 +1,217 @@
+# Microbenchmarks: what one lvgl read of each input device costs, on the host stand-ins (see sim).
+#
+# python bench/bench.py [--calls N] [--save] [--check] [case...]
+#
+# Every device is read N times (one lvgl read cycle per call: the reader is called again while it returns True,
+# the virtual clock moves by PERIOD ms between calls) under three scenarios:
+#     idle: nothing happens
+#     steady: a button held / the encoder turning one detent per call
+#     burst: taps and rotations between every call
+# and the following is reported per call:
+#     us: wall clock time (host time, only comparable on the same machine)
+#     bus: i2c transactions
+#     pcnt: PCNT driver calls
+# The heap allocations are not reported: the harness runs under CPython only (os.path, json, time.perf_counter and
+# the stand-ins), where tracemalloc measures CPython's own boxing and the stand-ins, not what microPython allocates.
+#
+# --save: saves the results as the baseline (bench/baseline.json)
+# --check: compares with the baseline and exits with 1 if some number went over its threshold (see LIMITS)
+# case: only run the cases whose name starts with one of these
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sim"))
+
+from scenario import fresh
+import espidf
+import lvgl as lv
+import simboard
+import utime
+from machine import I2C
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PERIOD = 30
+CALLS = 2000
+SCENARIOS = ("idle", "steady", "burst")
+# Regressions: (ratio, slack) -> new > old*ratio+slack
+LIMITS = {"us": (2.0, 2.0), "bus": (1.0, 0.01), "pcnt": (1.0, 0.01)}
+
+# M5Stack button pins, and a few more for the keypad
+A = 39
+B = 38
+C = 37
+KEYPINS = (36, 35, 34, 33)
+
+def _tapper(pins):
+    def act(i):
+        p = pins[i%len(pins)]
+        simboard.press(p)
+        utime.simAdvance(2000)
+        simboard.release(p)
+    return act
+
+def _idle(i):
+    pass
+
+# Each case builds a device on a fresh board and returns (list of readers, {scenario: action(i)})
+def caseKeypad():
+    from m5inputs.keypad import KeyButton, Keypad
+    kbd = Keypad()
+    for i in range(len(KEYPINS)):
+        KeyButton(KEYPINS[i], keyboard = kbd, key = 65+i)
+    kbd.registerDriver()
+    return [kbd.getReader()], {"idle": _idle, "steady": lambda i: simboard.press(KEYPINS[0]), "burst": _tapper(KEYPINS)}
+
+# The same in event mode: the PCNT ISRs flag the counters that moved
+def caseKeypadEvents():
+    from m5inputs.base import pcntBank
+    pcntBank.enableEvents()
+    return caseKeypad()
+
+# The same keys read with pin IRQs (the PCNT units all taken)
+def caseKeypadIrq():
+    from m5inputs.base import pcntUnits
+    for u in range(espidf.PCNT_UNIT.MAX):
+        pcntUnits.reserve(u, "bench")
+    return caseKeypad()
+
+# A 5x8 key matrix, 2 rows strobed per read. Burst: a different key down on every read
+def caseMatrixKeypad():
+    import simmatrix
+    from m5inputs.keypad import MatrixKeypad
+    rows = (2, 4, 5, 12, 13)
+    cols = (14, 15, 16, 17, 18, 19, 21, 22)
+    mat = simmatrix.FakeMatrix(rows, cols)
+    kbd = MatrixKeypad(rows, cols, [65+i for i in range(len(rows)*len(cols))])
+    kbd.registerDriver()
+    def burst(i):
+        mat.releaseAll()
+        mat.press(i%len(rows), (3*i)%len(cols))
+    return [kbd.getReader()], {"idle": _idle, "steady": lambda i: mat.press(0, 0), "burst": burst}
+
+def caseM5Buttons():
+    from m5inputs.m5buttons import M5Buttons
+    bt = M5Buttons()
+    bt.registerDriver()
+    return [bt.getReader()], {"idle": _idle, "steady": lambda i: simboard.press(A), "burst": _tapper((A, B, C))}
+
+def caseM5ButtonEncoder():
+    from m5inputs.m5encoder import M5ButtonEncoder
+    enc = M5ButtonEncoder()
+    enc.registerDriver()
+    return [enc.getReader()], {"idle": _idle, "steady": lambda i: simboard.press(C), "burst": _tapper((A, B, C))}
+
+def _navKey(intPin = None, updateOnly = False):
+    import simnavkey
+    from m5inputs.navkey import NavKey
+    dev = simnavkey.FakeNavKey(intPin = intPin)
+    nav = NavKey(I2C(0), intPin = intPin)
+    def burst(i):
+        k = i%5
+        dev.press(k)
+        dev.rotate(5)
+        dev.release(k)
+    readers = [nav.getKeyReader(), nav.getEncoderReader()]
+    if updateOnly:
+        def update(drv, data):
+            nav.update()
+            return False
+        readers = [update]
+    return readers, {"idle": _idle, "steady": lambda i: dev.rotate(1), "burst": burst}
+
+def caseNavKey():
+    return _navKey()
+
+def caseNavKeyInt():
+    return _navKey(intPin = 25)
+
+# A poll alone, without the lvgl readers and their snapshot: NavKey.update() (retry loop, refresh(), bus accounting,
+# event codes) on the fake bus
+def caseNavKeyUpdate():
+    return _navKey(updateOnly = True)
+
+CASES = [(n[4:], f) for n, f in sorted(globals().items()) if n.startswith("case")]
+
+def _cycle(readers, data):
+    for r in readers:
+        while r(None, data):
+            pass
+
+def _run(case, scenario, calls, measure):
+    fresh()
+    readers, acts = case()
+    act = acts[scenario]
+    data = lv.indev_data_t()
+    # Warm up: pending status, first snapshot...
+    for i in range(10):
+        act(i)
+        utime.simAdvance(PERIOD*1000)
+        _cycle(readers, data)
+    I2C.resetStats()
+    espidf.resetStats()
+    total = 0
+    for i in range(calls):
+        act(i)
+        utime.simAdvance(PERIOD*1000)
+        total += measure(readers, data)
+    return total/calls
+
+def _time(readers, data):
+    t0 = time.perf_counter()
+    _cycle(readers, data)
+    return (time.perf_counter()-t0)*1e6
+
+def bench(case, scenario, calls):
+    r = {}
+    r["us"] = _run(case, scenario, calls, _time)
+    r["bus"] = I2C.stats["transactions"]/calls
+    r["pcnt"] = sum(espidf.stats.values())/calls
+    return r
+
+def regressions(results, baseline):
+    out = []
+    for key, r in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for m, (ratio, slack) in LIMITS.items():
+            if m in r and m in old and r[m] > old[m]*ratio+slack:
+                out.append("{} {}: {:.2f} (baseline {:.2f})".format(key, m, r[m], old[m]))
+    return out
+
+def main(args):
+    calls = CALLS
+    save = "--save" in args
+    check = "--check" in args
+    if "--calls" in args:
+        calls = int(args[args.index("--calls")+1])
+    names = [a for a in args if not a.startswith("--") and not a.isdigit()]
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    results = {}
+    print("{:28} {:>9} {:>7} {:>7}".format("case", "us", "bus", "pcnt"))
+    for name, case in CASES:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        for sc in SCENARIOS:
+            key = "{}/{}".format(name, sc)
+            r = bench(case, sc, calls)
+            results[key] = r
+            print("{:28} {:9.1f} {:7.2f} {:7.2f}".format(key, r["us"], r["bus"], r["pcnt"]))
+    bad = regressions(results, baseline)
+    for b in bad:
+        print("REGRESSION {}".format(b))
+    if save:
+        for key, r in results.items():
+            baseline[key] = dict((m, round(v, 3)) for m, v in r.items())
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent = 1, sort_keys = True)
+        print("Baseline saved: {}".format(BASELINE))
+    return 1 if (check and bad) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
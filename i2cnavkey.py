@@ -10,12 +10,18 @@ navAddr = const(0x10)
 # registers
 # Just a selection of now !
 rGConf = const(0x0)
+rIntConf = const(0x04)
 rIStatus = const(0x06)
 rCVal = const(0x0A)
 rCMax = const(0x0E)
 rCMin = const(0x12)
 rIStep = const(0x16)
 
+# Burst window: IStatus (0x06-0x07), GPIO/reserved (0x08-0x09) and CVal (0x0A-0x0D) in one read
+BURSTLEN = const(rCVal+4-rIStatus)
+# Configuration window: CMax (0x0E-0x11), CMin (0x12-0x15) and IStep (0x16-0x19), written in one go
+CONFLEN = const(rIStep+4-rCMax)
+
 # flags for GConf
 fDType = const(0b1<<0)
 fWrapE = const(0b1<<1)
@@ -40,6 +46,10 @@ fRDec = const(0b1<<12)
 fRMax = const(0b1<<13)
 fRMin = const(0b1<<14)
 
+# Masks for IntConf (same layout as IStatus)
+mKeys = const(fUPR|fUPP|fDNR|fDNP|fRTR|fRTP|fLTR|fLTP|fCTRR|fCTRP)
+mEnc = const(fRInc|fRDec|fRMax|fRMin)
+
 UP = const(0)
 DN = const(1)
 LT = const(2)
@@ -50,6 +60,18 @@ ROT = const(6)
 MAXMIN = const(7)
 MAXSTATES = const(8)
 
+# Events as masks: bit k for the state k above (UP to MAXMIN)
+KEYEVENTS = const(0x3F)
+ENCEVENTS = const(0xC0)
+# Event codes: (k<<1)|1 for "pressed" (rotation up, max reached...), k<<1 for "released", NOEVENT if nothing happened
+NOEVENT = const(-1)
+
+# A reset takes 400us
+RESETUS = const(400)
+
+# Bus utilization is worked out over windows of (at least) WINDOW ms
+WINDOW = const(1000)
+
 
 
 def triVal(pr, re):
@@ -60,130 +82,408 @@ def triVal(pr, re):
     else:
         return None
 
+# Decoding tables of the status word: for each value of a byte, the mask of the states it sets.
+# pairs: (bit in the byte, state)
+def decodeTable(pairs):
+    t = bytearray(256)
+    for v in range(256):
+        m = 0
+        for b, k in pairs:
+            if v&(1<<b):
+                m |= 1<<k
+        t[v] = m
+    return bytes(t)
+
+# Low byte (0x07): UP, DN, RT, LT. High byte (0x06): CTR, CTRD, ROT, MAXMIN
+PRESSLO = decodeTable(((1, UP), (3, DN), (5, RT), (7, LT)))
+RELEASELO = decodeTable(((0, UP), (2, DN), (4, RT), (6, LT)))
+PRESSHI = decodeTable(((1, CTR), (2, CTRD), (3, ROT), (5, MAXMIN)))
+RELEASEHI = decodeTable(((0, CTR), (4, ROT), (6, MAXMIN)))
+
+# Big endian signed 32 bits integer at b[i], without ustruct (no tuple). Small ints as long as abs(value)<2**30
+def int32(b, i):
+    v = b[i]
+    if v&0x80:
+        v -= 0x100
+    return (((v<<8|b[i+1])<<8|b[i+2])<<8)|b[i+3]
+
 # Class that attempts to manage this navkey: https://www.tindie.com/products/saimon/i2c-navkey-7-functions-joypad-on-the-i2c-bus
-# No IRQs or some sutch. Only polling...
+# No IRQs or some sutch. Only polling... The INT line can be programmed with setInterrupts(), watching it is up to the caller.
 # WIP!
 #
-# I2CNavKey(i2c, [addr = navAddr], [debug=False])
+# I2CNavKey(i2c, [addr = navAddr], [debug=False], [wait = True])
 # creates an object managing navkey at address adr on i2c bus i2c.
 # i2c: an I2C object describing the bus
 # addr: address of the navkey. By default navAddr=CONST(0x10)
 # debug: flag for... debugging.
+# wait: if True, the navkey is initialized with initNavKey() (blocks for the 400us of the reset). If False, with
+#     startInit(): the configuration is finished by the first finishInit() after the reset.
 #
 # Methods:
-# resetNavkey(): resets the navkey. sleeps for 400us in order to wait for the restart. TBD: add a flag to forego the sleep
-# initNavKey(): initializes the navkey. Starts by resetting it... The encoder is set to wrap.
+# resetNavkey(): resets the navkey. sleeps for 400us in order to wait for the restart.
+# initNavKey(): initializes the navkey. Starts by resetting it... The encoder is set to wrap. Blocks until the navkey
+#     has restarted.
+# startInit(): starts the initialization without blocking: resets the navkey and records when the reset is over
+#     (RESETUS us later). Until then the configuration calls (setEncoderBounds(), setInterrupts()) are only recorded.
+# finishInit(): if the reset is over, writes the configuration (wrap, bounds, interrupts) once. Returns True if the
+#     navkey is ready. Several navkeys can be reset in parallel, while the display is set up for instance.
+# @property ready: True if the navkey is initialized (no bus access)
 # setEcoderBounds([min = -5], [max = 5], [step = 1]): stets the minimum, maximum bound and the step for the encoder.
+#     Only the registers that changed are written, in a single transaction (CMax, CMin and IStep are contiguous).
+#     Written by finishInit() if the navkey is not ready yet.
+# setInterrupts(mask): programs the interrupt configuration register: the INT line is asserted (low) while
+#     one of the events of mask (IStatus flags, see mKeys and mEnc) is pending. mask = 0 disables the INT line.
+#     Not written if mask is already programmed. Written by finishInit() if the navkey is not ready yet.
+# invalidateShadow(): forgets the shadow of the configuration registers (GConf, IntConf, CMax, CMin, IStep): the next
+#     configuration calls write everything. Done by resetNavKey(). Needed if something else wrote to the navkey.
+# refresh([burst = True]): the poll, written not to allocate. Reads the status and the encoder: in one transaction if burst,
+#     else the status, then the encoder only if the status says it moved. Updates the masks and the encoder value.
+# @property pressedMask: the states (bit k for state k) "pressed" by the last read: key pressed, rotation up, max reached
+# @property releasedMask: the states "released" by the last read: key released, rotation down, min reached
+# keyCode(): the event of the first key (UP, DN, LT, RT, CTR, CTRD in that order) in the last read, as an event code
+#     ((key<<1)|1 pressed, key<<1 released) or NOEVENT
+# encoderCode(): the same for the encoder (ROT, then MAXMIN)
 # updateStatus(): reads the status registe and updates the various flags
+# decodeStatus(fl): updates the various flags from the status word fl
 # getStatus(): updates the status and returns it  as a list of:
 #     True (pressed), False (released), None (untouched since last poll)
 # getEncoder(): gets the encoder value as a signed integer
+# burstRead(): reads the status and the encoder value (registers 0x06 to 0x0D) in a single i2c transaction.
+#     Updates the flags and the encoder value and returns the status (as getStatus() does).
+# @property encoder: the encoder value read by the last getEncoder()/burstRead()/refresh(). No bus access.
 # keyEvent(): gets the last key event as a tuple (bool, obj). Two forms
 #     (False, None) if there was no new event,
 #     (True, (key, bool)) where key is the key code and bool is True iff the key is pressed.
 # encoderEvent(): gets the last encoder event as a tuple (bool, obj). Two forms
 #     (False, None) if there was no new event,
 #     (True, (nat, bool)) where nat is the code (either rotation or bounds touched) and bool is True depending on the nature (see datasheet).
+# The list and the tuples of getStatus(), burstRead(), keyEvent() and encoderEvent() are kept for compatibility:
+#     refresh(), the masks and the codes are written not to allocate (preallocated buffers, small ints).
 # 
 # There are quite a few other internals dealing with i2c communication and reading/writing 1,2 or 4 bytes from/to a register.
+# They all go through _readInto()/_writeFrom(), which keep the bus accounting:
+# busStats(): returns (transactions, bytes, errors, bus time in ms) since the start or the last resetBusStats().
+#     bytes: the data bytes moved (register addresses not included). Bus time: measured around each
+#     transaction with utime.ticks_us(), ie the time the caller was blocked.
+# @property utilization: the share of the time (in per-mille) the bus was busy with this navkey over the last
+#     window of at least WINDOW ms
+# @property rate: the transactions per second over the same window
+# resetBusStats(): zeroes the counters
+# busReport(): prints all of the above
 
 
 class I2CNavKey(object):
-    def __init__(self, i2c, addr = navAddr, debug = False):
+    def __init__(self, i2c, addr = navAddr, debug = False, wait = True):
         self._i2c = i2c
         self._addr = addr
         self._debug = debug
         self._buf1 = bytearray(1)
         self._buf2 = bytearray(2)
         self._buf4 = bytearray(4)
+        self._bufS = bytearray(BURSTLEN)
+        self._bufC = bytearray(CONFLEN)
+        # Shadow of the configuration registers: what was last written to the navkey
+        self._shadowC = bytearray(CONFLEN)
+        self.invalidateShadow()
         self._status = [None]*MAXSTATES
+        self._pr = 0
+        self._rel = 0
+        self.resetBusStats()
+        self._enc = 0
 
-        self.initNavKey()
+        # The configuration is recorded until the init is over
+        self._ready = False
+        self._tReady = 0
+        self._intMask = -1
         self.setEncoderBounds(min = 0, max = 15, step = 1)
-        self._enc = 0
+        if wait:
+            self.initNavKey()
+        else:
+            self.startInit()
     
 
+    # The only bus accesses: both are counted (even when they fail)
+    def _readInto(self, dev, mem, buf):
+        t0 = utime.ticks_us()
+        try:
+            self._i2c.readfrom_mem_into(dev, mem, buf)
+        except OSError:
+            self._nErr += 1
+            raise
+        finally:
+            self._account(t0, len(buf))
+
+    def _writeFrom(self, dev, mem, buf):
+        t0 = utime.ticks_us()
+        try:
+            self._i2c.writeto_mem(dev, mem, buf)
+        except OSError:
+            self._nErr += 1
+            raise
+        finally:
+            self._account(t0, len(buf))
+
+    # Small ints only: the bus time is kept as ms + us
+    def _account(self, t0, n):
+        dt = utime.ticks_diff(utime.ticks_us(), t0)
+        self._nTrans += 1
+        self._nBytes += n
+        us = self._busUs+dt
+        if us>=1000:
+            self._busMs += us//1000
+            us = us%1000
+        self._busUs = us
+        self._winUs += dt
+        self._winN += 1
+        self._roll()
+
+    # Closes the utilization window if it is over
+    def _roll(self):
+        now = utime.ticks_ms()
+        el = utime.ticks_diff(now, self._winT)
+        if el>=WINDOW:
+            # us per ms: per-mille
+            self._util = self._winUs//el
+            self._rate = self._winN*1000//el
+            self._winT = now
+            self._winUs = 0
+            self._winN = 0
+
+    def resetBusStats(self):
+        self._nTrans = 0
+        self._nBytes = 0
+        self._nErr = 0
+        self._busMs = 0
+        self._busUs = 0
+        self._winT = utime.ticks_ms()
+        self._winUs = 0
+        self._winN = 0
+        self._util = 0
+        self._rate = 0
+
+    def busStats(self):
+        return (self._nTrans, self._nBytes, self._nErr, self._busMs)
+
+    @property
+    def utilization(self):
+        self._roll()
+        return self._util
+
+    @property
+    def rate(self):
+        self._roll()
+        return self._rate
+
+    def busReport(self):
+        print("navkey 0x{:02x}: {} transactions, {} bytes, {} errors, bus time: {}ms. Last window: {}/1000 busy, {} transactions/s".format(
+            self._addr, self._nTrans, self._nBytes, self._nErr, self._busMs, self.utilization, self.rate))
+
     def read1(self, dev, mem):
-        self._i2c.readfrom_mem_into(dev, mem, self._buf1)
+        self._readInto(dev, mem, self._buf1)
         return self._buf1[0]
 
     def write1(self, dev, mem, byte):
         self._buf1[0] = byte
-        self._i2c.writeto_mem(dev, mem, self._buf1)
+        self._writeFrom(dev, mem, self._buf1)
 
     def read2(self, dev, mem):
-        self._i2c.readfrom_mem_into(dev, mem, self._buf2)
-        a = ustruct.unpack(">H", self._buf2)
-        return a[0]
+        self._readInto(dev, mem, self._buf2)
+        return (self._buf2[0]<<8)|self._buf2[1]
 
     def write2(self, dev, mem, word):
         ustruct.pack_into(">H", self._buf2, 0, word)
-        self._i2c.writeto_mem(dev, mem, self._buf2)
+        self._writeFrom(dev, mem, self._buf2)
 
     def read4(self, dev, mem):
-        self._i2c.readfrom_mem_into(dev, mem, self._buf4)
-        a = ustruct.unpack(">i", self._buf4)
-        return a[0]
+        self._readInto(dev, mem, self._buf4)
+        return int32(self._buf4, 0)
 
     def write4(self, dev, mem, word):
         ustruct.pack_into(">i", self._buf4, 0, word)
-        self._i2c.writeto_mem(dev, mem, self._buf4)
+        self._writeFrom(dev, mem, self._buf4)
 
     def resetNavKey(self):
         # Reset the navKey
         self.write1(self._addr, rGConf, fReset)
+        # The registers are back to their defaults
+        self.invalidateShadow()
         # A reset takes 400us.
-        utime.sleep_us(400)
+        utime.sleep_us(RESETUS)
 
     def initNavKey(self):
-        self.resetNavKey()
-        # Should I have another choice ?
-        # Wrap and increase in counter-trig direction
-        self.write1(self._addr, rGConf, fWrapE)
+        self.startInit()
+        dt = utime.ticks_diff(self._tReady, utime.ticks_us())
+        if dt>0:
+            utime.sleep_us(dt)
+        self.finishInit()
+
+    def startInit(self):
+        self._ready = False
+        self.write1(self._addr, rGConf, fReset)
+        self.invalidateShadow()
+        self._tReady = utime.ticks_add(utime.ticks_us(), RESETUS)
+
+    def finishInit(self):
+        if self._ready:
+            return True
+        if utime.ticks_diff(utime.ticks_us(), self._tReady)<0:
+            return False
+        self._ready = True
+        try:
+            # Should I have another choice ?
+            # Wrap and increase in counter-trig direction
+            self._setGConf(fWrapE)
+            self.setEncoderBounds(self._minEnc, self._maxEnc, self._stepEnc)
+            if self._intMask>=0:
+                self.setInterrupts(self._intMask)
+        except OSError:
+            # The shadow knows what went through: the next call writes the rest
+            self._ready = False
+            raise
+        return True
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def invalidateShadow(self):
+        self._shadowOK = False
+        self._gconf = -1
+        self._intconf = -1
+
+    def _setGConf(self, flags):
+        if flags!=self._gconf:
+            self.write1(self._addr, rGConf, flags)
+            self._gconf = flags
 
     def setEncoderBounds(self, min = -5, max = 5, step = 1):
         self._minEnc = min
         self._maxEnc = max
         self._stepEnc = step
         self._mod = max-min+1
-        self.write4(self._addr, rCMax, self._maxEnc)
-        self.write4(self._addr, rCMin, self._minEnc)
-        self.write4(self._addr, rIStep, self._stepEnc)
+        if not self._ready:
+            return
+        b = self._bufC
+        sh = self._shadowC
+        ustruct.pack_into(">iii", b, 0, max, min, step)
+        lo = 0
+        hi = CONFLEN
+        if self._shadowOK:
+            # Only the span that changed, in whole registers
+            while lo<CONFLEN and b[lo]==sh[lo]:
+                lo += 1
+            if lo==CONFLEN:
+                return
+            while b[hi-1]==sh[hi-1]:
+                hi -= 1
+            lo = lo&~3
+            hi = (hi+3)&~3
+        self._writeFrom(self._addr, rCMax+lo, memoryview(b)[lo:hi])
+        for i in range(lo, hi):
+            sh[i] = b[i]
+        self._shadowOK = True
+    
+    def setInterrupts(self, mask):
+        self._intMask = mask
+        if self._ready and mask!=self._intconf:
+            self.write2(self._addr, rIntConf, mask)
+            self._intconf = mask
        
   
+    # hi, lo: the bytes of the status word
+    def _decode(self, hi, lo):
+        self._pr = PRESSLO[lo]|PRESSHI[hi]
+        self._rel = RELEASELO[lo]|RELEASEHI[hi]
+    
+    def refresh(self, burst = True):
+        if burst:
+            b = self._bufS
+            self._readInto(self._addr, rIStatus, b)
+            self._decode(b[0], b[1])
+            self._enc = int32(b, rCVal-rIStatus)
+        else:
+            b = self._buf2
+            self._readInto(self._addr, rIStatus, b)
+            self._decode(b[0], b[1])
+            if (self._pr|self._rel)&ENCEVENTS:
+                self.getEncoder()
+    
+    @property
+    def pressedMask(self):
+        return self._pr
+    
+    @property
+    def releasedMask(self):
+        return self._rel
+    
+    def _code(self, events):
+        ev = (self._pr|self._rel)&events
+        if ev==0:
+            return NOEVENT
+        k = 0
+        while not ev&1:
+            ev >>= 1
+            k += 1
+        if self._pr&(1<<k):
+            return (k<<1)|1
+        return k<<1
+    
+    def keyCode(self):
+        return self._code(KEYEVENTS)
+    
+    def encoderCode(self):
+        return self._code(ENCEVENTS)
+    
+    # The status as a list (compatibility)
+    def _fillStatus(self):
+        st = self._status
+        for k in range(MAXSTATES):
+            m = 1<<k
+            if self._pr&m:
+                st[k] = True
+            elif self._rel&m:
+                st[k] = False
+            else:
+                st[k] = None
+        return st
+  
     def updateStatus(self):
-        fl = self.read2(self._addr, rIStatus)
-        self._status[UP] = triVal(fl&fUPP, fl&fUPR)
-        self._status[DN] = triVal(fl&fDNP, fl&fDNR)
-        self._status[LT] = triVal(fl&fLTP, fl&fLTR)
-        self._status[RT] = triVal(fl&fRTP, fl&fRTR)
-        self._status[CTR] = triVal(fl&fCTRP, fl&fCTRR)
-        self._status[CTRD] = triVal(fl&fCTRDP, 0)
-        self._status[ROT] = triVal(fl&fRInc, fl&fRDec)
-        self._status[MAXMIN] = triVal(fl&fRMax, fl&fRMin)
+        b = self._buf2
+        self._readInto(self._addr, rIStatus, b)
+        self._decode(b[0], b[1])
+    
+    def decodeStatus(self, fl):
+        self._decode((fl>>8)&0xFF, fl&0xFF)
+        self._fillStatus()
     
     def getStatus(self):
         self.updateStatus()
-        return self._status
+        return self._fillStatus()
     
     def getEncoder(self):
         a = self.read4(self._addr, rCVal)
         self._enc = a
         return a
     
+    def burstRead(self):
+        self.refresh(True)
+        return self._fillStatus()
+    
+    @property
+    def encoder(self):
+        return self._enc
+    
     def keyEvent(self):
-        for k in [UP, DN, LT, RT, CTR, CTRD]:
-            st = self._status[k]
-            if st is not None:
-                return (True, (k, st)) 
-        return (False, None)
+        c = self.keyCode()
+        if c==NOEVENT:
+            return (False, None)
+        return (True, (c>>1, (c&1)==1))
     
     def encoderEvent(self):
-        for k in [ROT, MAXMIN]:
-            st = self._status[k]
-            if st is not None:
-                return (True, (k, st)) 
-        return (False, None)
+        c = self.encoderCode()
+        if c==NOEVENT:
+            return (False, None)
+        return (True, (c>>1, (c&1)==1))
         
 #     def getEncoder(self):
 #         a = self.read4(self._addr, rCVal)
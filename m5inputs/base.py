@@ -1,55 +1,421 @@
 # No docstrings: this is microPython, and space comes at a premium
 import lvgl as lv
 import espidf
+import utime
+from array import array
 
-# from machine import Pin
+from machine import Pin, disable_irq, enable_irq
 from micropython import const
 
 # I have not found it in espidf. Weird?
 PCNT_PIN_NOT_USED = const(-1)
+# esp_err_t: the driver calls return them, they do not raise
+ESP_OK = const(0)
+ESP_ERR_INVALID_STATE = const(0x103)
 
 MAXSHORT = const(0x7FFF)
 # Arbitrary. Just to brevent overflowing. Anythin less than MAXSHORT and large enough
 MAXCOUNT = const(1000) 
+# Generations of the snapshots wrap around: they are only compared for equality
+GENMASK = const(0x3FFF)
+# Event mode: the counter goes 0, 1, back to 0 (high limit). One event per edge (threshold 0 at 1, high limit at 2)
+EVTLIM = const(2)
+# Reader timing: number of buckets and width of a bucket (us). The last bucket takes everything above.
+HISTBUCKETS = const(32)
+HISTWIDTH = const(100)
+# Latency tracing: number of events kept
+TRACESIZE = const(64)
+# IRQButton: edges kept between two updates (a power of 2), and the debounce time (us)
+RINGSIZE = const(16)
+RINGMASK = const(RINGSIZE-1)
+DEBOUNCE = const(2000)
+# IRQPin: the edge count wraps at EDGEMASK+1 (a multiple of RINGSIZE, in small ints)
+EDGEMASK = const(0x3FFFFFFF)
+# IRQButton: ms without an update after which the debounce reference is dropped (ticks_us() wraps around in 17 min,
+# ticks_diff() is wrong past 8 min)
+STALEMS = const(60000)
+# Bits of pcntBank's masks given to the IRQButtons: from PCNT_UNIT.MAX (8) up to 29 (small ints)
+MAXSOURCE = const(30)
+
+# A class that reads all the allocated pulse counters at once, into a preallocated array.
+# There is one: pcntBank, shared by all the PCNTButtons (and flagged by the IRQButtons). The devices refresh it
+# once per lvgl tick and the buttons derive their state from the snapshot. No allocation when reading.
+#
+# Two modes:
+#     polling (the default): read() reads every unit (one driver call each)
+#     events (enableEvents()): the PCNT interrupts count the edges of each unit and flag it. read() only takes
+#         the flagged units (one driver call each, to check the parity against the counter). Idle, it costs an
+#         integer check.
+#
+# PCNTBank()
+#
+# Methods:
+# add(unit): adds PCNT unit unit to the units read by the bank. In event mode, sets up its events and ISR. Returns
+#     False if that failed (a driver call returned an error): the unit is polled then, as in polling mode.
+# remove(unit): stops reading unit (and removes its ISR)
+# enableEvents(): switches to the event mode. Has to be called before the first PCNTButton is created (the units are
+#     configured for it). Returns False (and stays in polling mode) if the PCNT ISR service cannot be installed
+#     (any error but ESP_ERR_INVALID_STATE, already installed).
+# @property polled: the units polled in event mode (bit u for unit u), their events could not be set up
+# @property events: True in event mode
+# read(): reads all the units (the flagged ones in event mode) into the snapshot. Zeroes a counter if
+#     abs(count)>=MAXCOUNT
+# readUnit(unit): reads only unit (same rules), updates its snapshot and returns the count
+# refresh(seen): reads all the units if generation seen is the current one (ie: the caller has already used
+#     this snapshot). Returns the current generation. Devices keep the generation they saw last: several
+#     devices read during the same lvgl tick share one snapshot, and a single device reads on each call.
+# count(unit): the count of unit in the current snapshot
+# @property gen: the generation of the current snapshot
+# @property changed: the units (bit u for unit u) whose count changed in the last read
+# addSource(): returns a bit (above the PCNT units) for an input that is not a PCNT unit (IRQButton). Its ISR
+#     flags it with flag(): the next read marks it as changed.
+# removeSource(b): gives back source bit b (reused by the next addSource())
+# flag(mask): flags the sources in mask. Called from ISRs
+# subscribe(): returns a subscriber id for a device. The bank accumulates the units changed by every read for each
+#     subscriber, until it takes them.
+# take(sub): returns and clears the units changed since subscriber sub last took them. A device whose units are not
+#     in there can skip its scan, whichever device made the bank read.
+# unsubscribe(sub): gives back subscriber id sub (reused by the next subscribe())
+#
+class PCNTBank(object):
+    def __init__(self):
+        self._counts = array('h', [0]*espidf.PCNT_UNIT.MAX)
+        self._units = []
+        self._ptr = espidf.C_Pointer()
+        self._gen = 0
+        self._changed = 0
+        # Units changed, per subscriber
+        self._dirty = []
+        # Event mode: edges counted by the ISRs, units they flagged, the ISRs (kept referenced)
+        self._events = False
+        self._edges = array('H', [0]*espidf.PCNT_UNIT.MAX)
+        self._taken = array('H', [0]*espidf.PCNT_UNIT.MAX)
+        self._pending = 0
+        self._isrs = [None]*espidf.PCNT_UNIT.MAX
+        # Event mode: units whose events could not be set up, polled instead
+        self._polled = 0
+        # Source bits in use
+        self._sources = 0
+    
+    def add(self, unit):
+        if unit in self._units:
+            return not (self._polled&(1<<unit))
+        self._units.append(unit)
+        if self._events and not self._setupEvents(unit):
+            self._polled |= 1<<unit
+            return False
+        return True
+    
+    def remove(self, unit):
+        if unit not in self._units:
+            return
+        self._units.remove(unit)
+        if self._events and not (self._polled&(1<<unit)):
+            self._stopEvents(unit)
+            self._pending &= ~(1<<unit)
+            self._edges[unit] = 0
+        self._polled &= ~(1<<unit)
+        self._counts[unit] = 0
+    
+    def enableEvents(self):
+        if self._events:
+            return True
+        if self._units:
+            raise ValueError("enableEvents() has to be called before creating the buttons")
+        err = espidf.pcnt_isr_service_install(0)
+        if err!=ESP_OK and err!=ESP_ERR_INVALID_STATE:
+            return False
+        self._events = True
+        return True
+    
+    @property
+    def events(self):
+        return self._events
+    
+    @property
+    def polled(self):
+        return self._polled
+    
+    # Returns False (nothing left set up) if a driver call failed
+    def _setupEvents(self, unit):
+        m = 1<<unit
+        # ISR: keep it short. No allocation
+        def isr(arg):
+            self._edges[unit] += 1
+            self._pending |= m
+        self._isrs[unit] = isr
+        if (espidf.pcnt_set_event_value(unit, espidf.PCNT_EVT.THRES_0, 1)!=ESP_OK
+                or espidf.pcnt_event_enable(unit, espidf.PCNT_EVT.THRES_0)!=ESP_OK
+                or espidf.pcnt_event_enable(unit, espidf.PCNT_EVT.H_LIM)!=ESP_OK
+                or espidf.pcnt_isr_handler_add(unit, isr, None)!=ESP_OK
+                or espidf.pcnt_intr_enable(unit)!=ESP_OK):
+            self._stopEvents(unit)
+            return False
+        return True
+    
+    def _stopEvents(self, unit):
+        espidf.pcnt_intr_disable(unit)
+        espidf.pcnt_isr_handler_remove(unit)
+        espidf.pcnt_event_disable(unit, espidf.PCNT_EVT.THRES_0)
+        espidf.pcnt_event_disable(unit, espidf.PCNT_EVT.H_LIM)
+        self._isrs[unit] = None
+    
+    def addSource(self):
+        for b in range(espidf.PCNT_UNIT.MAX, MAXSOURCE):
+            if not (self._sources&(1<<b)):
+                self._sources |= 1<<b
+                return b
+        raise ValueError("Too many inputs...")
+    
+    def removeSource(self, b):
+        self._sources &= ~(1<<b)
+        self._pending &= ~(1<<b)
+    
+    def flag(self, m):
+        self._pending |= m
+    
+    # Free ids are -1: _mark() leaves them alone
+    def subscribe(self):
+        d = self._dirty
+        for i in range(len(d)):
+            if d[i]<0:
+                d[i] = 0
+                return i
+        d.append(0)
+        return len(d)-1
+    
+    def unsubscribe(self, sub):
+        self._dirty[sub] = -1
+    
+    def take(self, sub):
+        d = self._dirty[sub]
+        self._dirty[sub] = 0
+        return d
+    
+    def _mark(self, m):
+        self._changed |= m
+        d = self._dirty
+        i = len(d)
+        while i>0:
+            i -= 1
+            d[i] |= m
+    
+    # Takes the edges counted by the PCNT ISRs (event mode) and the sources flagged
+    def _drain(self):
+        st = disable_irq()
+        p = self._pending
+        self._pending = 0
+        if p:
+            for u in self._units:
+                self._taken[u] = self._edges[u]
+                self._edges[u] = 0
+        enable_irq(st)
+        if p==0:
+            return
+        for u in self._units:
+            if p&(1<<u):
+                cnt = self._counts[u]+self._taken[u]
+                # The counter holds the parity: an edge missed by the ISRs (coalesced interrupts) shows there
+                espidf.pcnt_get_counter_value(u, self._ptr)
+                if (cnt^self._ptr.int_val)&1:
+                    cnt += 1
+                if cnt>MAXCOUNT:
+                    cnt = cnt&1
+                self._counts[u] = cnt
+                self._mark(1<<u)
+        p >>= espidf.PCNT_UNIT.MAX
+        if p:
+            self._mark(p<<espidf.PCNT_UNIT.MAX)
+    
+    def readUnit(self, unit):
+        if self._events and not (self._polled&(1<<unit)):
+            self._drain()
+            return self._counts[unit]
+        return self._poll(unit)
+    
+    def _poll(self, unit):
+        espidf.pcnt_get_counter_value(unit, self._ptr)
+        cnt = self._ptr.int_val
+        if cnt>MAXCOUNT or cnt<-MAXCOUNT:
+            espidf.pcnt_counter_clear(unit)
+        if cnt!=self._counts[unit]:
+            self._counts[unit] = cnt
+            self._mark(1<<unit)
+        return cnt
+    
+    def read(self):
+        self._changed = 0
+        if self._events:
+            self._drain()
+            if self._polled:
+                for u in self._units:
+                    if self._polled&(1<<u):
+                        self._poll(u)
+        else:
+            for u in self._units:
+                self.readUnit(u)
+            if self._pending:
+                self._drain()
+        self._gen = (self._gen+1)&GENMASK
+    
+    def refresh(self, seen):
+        if seen==self._gen:
+            self.read()
+        return self._gen
+    
+    def count(self, unit):
+        return self._counts[unit]
+    
+    @property
+    def gen(self):
+        return self._gen
+    
+    @property
+    def changed(self):
+        return self._changed
+
+pcntBank = PCNTBank()
+
+# A class that hands out the PCNT units. There is one: pcntUnits. A unit counts one pin and is shared by all the
+# users (PCNTButtons) of that pin. It is free again when its last user releases it, and is reused by the next claim:
+# the devices can be rebuilt over and over. Units can also be reserved for something else than the buttons.
+#
+# PCNTAllocator()
+#
+# Methods:
+# claim(pinN, user, [unit = None]): returns the unit counting pin pinN for user. The pin's unit if it is already
+#     counted, else unit (which has to be free) or the lowest free unit. Raises ValueError if there is none, or if
+#     unit does not match. The caller configures the unit if user is its only one.
+# reserve(unit, owner): takes unit for owner (anything: a name...), outside of the buttons
+# release(unit, user): user gives unit back. Returns True if the unit is free after that.
+# users(unit): the users of unit (an empty list if it is free)
+# unitOf(pinN): the unit counting pinN (None if none)
+# @property free: the number of free units
+# table(): the allocated units as a list of (unit, pin or -1, [owners]). The owner of a button is the device
+#     it belongs to.
+# report(): prints the table
+#
+class PCNTAllocator(object):
+    def __init__(self):
+        self._pins = array('b', [-1]*espidf.PCNT_UNIT.MAX)
+        # None: free
+        self._users = [None]*espidf.PCNT_UNIT.MAX
+    
+    def unitOf(self, pinN):
+        for u in range(len(self._users)):
+            if self._users[u] is not None and self._pins[u]==pinN:
+                return u
+        return None
+    
+    def claim(self, pinN, user, unit = None):
+        u = self.unitOf(pinN)
+        if u is not None:
+            if unit is not None and unit!=u:
+                raise ValueError("Pin {} already counted by unit {}".format(pinN, u))
+        else:
+            if unit is None:
+                if self.free==0:
+                    raise ValueError("Too many counter units allocated...")
+                u = self._users.index(None)
+            elif self._users[unit] is not None:
+                raise ValueError("Counter unit {} already allocated".format(unit))
+            else:
+                u = unit
+            self._pins[u] = pinN
+            self._users[u] = []
+        self._users[u].append(user)
+        return u
+    
+    def reserve(self, unit, owner):
+        if self._users[unit] is not None:
+            raise ValueError("Counter unit {} already allocated".format(unit))
+        self._pins[unit] = -1
+        self._users[unit] = [owner]
+    
+    def release(self, unit, user):
+        us = self._users[unit]
+        if us is None or user not in us:
+            return False
+        us.remove(user)
+        if us:
+            return False
+        self._users[unit] = None
+        self._pins[unit] = -1
+        return True
+    
+    def users(self, unit):
+        return self._users[unit] or []
+    
+    @property
+    def free(self):
+        return self._users.count(None)
+    
+    def table(self):
+        return [(u, self._pins[u], [getattr(b, "owner", b) for b in self._users[u]])
+                for u in range(len(self._users)) if self._users[u] is not None]
+    
+    def report(self):
+        for u, pinN, owners in self.table():
+            print("unit {}: pin {}, {}".format(u, pinN, owners))
+
+pcntUnits = PCNTAllocator()
 
 # A class that uses the pulse counter to read an IO.
 #
-# PCNTButton(pinN, [unit]) : watches pin number pinN and uses PCNT unit unit. if unit==None,
-# automatically allocates a PCNT unit.
+# PCNTButton(pinN, [unit], [owner]) : watches pin number pinN and uses PCNT unit unit. if unit==None,
+# a PCNT unit is taken from pcntUnits. owner: the device the button belongs to (shown by pcntUnits.table())
+# The counters are shared: the PCNTButtons on the same pin (M5Buttons and M5ButtonEncoder both use A/B/C) use the
+# same unit, counted once (see PCNTAllocator). Each keeps its own cursor (the count seen at its last update()).
+# unit, if given, has to be the pin's unit (or a free one).
 #
 # Methods:
-# @property pressed: True iff the button is pressed
-# getCount(): gets the count number. Zeroes it if abs(count)>=MAXCOUNT
+# @property pressed: True iff the button is pressed. Taken from pcntBank's snapshot: no driver call, but the
+#     snapshot has to be refreshed (the devices do it in update())
+# update(): compares the snapshot with the count seen at the previous update() to find the edges in between.
+#     Called once per poll by the device owning the button.
+# @property taps: the number of press/release pairs that happened between the last two update()s on top of what
+#     pressed shows: a tap shorter than the read period adds two edges without changing the parity of the count.
+#     If the button is held, a "tap" is a quick release/press.
+# getCount(): reads the count number now (and updates the snapshot). Zeroes it if abs(count)>=MAXCOUNT
 # clearCount(): zeroes the counter.
+# @property unitMask: the bit of the button's unit in pcntBank's masks (changed, take())
+# release(): gives back the counter. The last button on a unit stops it, takes it out of pcntBank and frees it. The
+#     button cannot be used after that. A button is a context manager: it is released at the end of a with block.
+# @property owner: the owner given (the button itself if None)
 #
 # For the time being, the private methods/variables are not that private...
 #
 class PCNTButton(object):
-    # I am unhappy with allocating pcnt units automagically.
-    # I could use a lookup table with a singleton object ?
-    currentUnit = espidf.PCNT_UNIT._0
-    
-    def __init__(self, pinN, unit = None):
+    def __init__(self, pinN, unit = None, owner = None):
         self._pinN = pinN
+        self._taps = 0
+        self._owner = owner
         # what argument name (if needed)? 
         self._filter = 1023
-        if unit is None:
-            self._allocatePCNT()
-        else:
-            self._unit = unit
-        self._setupPCNT()
+        self._unit = pcntUnits.claim(pinN, self, unit)
+        if len(pcntUnits.users(self._unit))==1:
+            self._setupPCNT(pcntBank.events)
+            if not pcntBank.add(self._unit):
+                # No events for this unit: polled, with the full range of the counter
+                self._setupPCNT(False)
+        self._live = True
+        # The edges before this button are not its own
+        self._last = pcntBank.count(self._unit)
     
     def __repr__(self):
         return "PCNTButton({})".format(self._unit)
     
-    def _allocatePCNT(self):
-        if PCNTButton.currentUnit<espidf.PCNT_UNIT.MAX:
-            self._unit = PCNTButton.currentUnit
-            PCNTButton.currentUnit += 1
-        else:
-            raise ValueError("Too many counter units allocated...")
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
     
-    def _setupPCNT(self):
+    @property
+    def owner(self):
+        return self if self._owner is None else self._owner
+    
+    def _setupPCNT(self, events):
         cntConfig = espidf.pcnt_config_t()
         cntConfig.channel = espidf.PCNT_CHANNEL._0
         cntConfig.pulse_gpio_num = self._pinN
@@ -59,7 +425,10 @@ class PCNTButton(object):
         cntConfig.neg_mode = espidf.PCNT_COUNT.INC
         cntConfig.lctrl_mode = espidf.PCNT_MODE.KEEP
         cntConfig.hctrl_mode = espidf.PCNT_MODE.KEEP
-        cntConfig.counter_h_lim = MAXSHORT
+        if events:
+            cntConfig.counter_h_lim = EVTLIM
+        else:
+            cntConfig.counter_h_lim = MAXSHORT
         cntConfig.counter_l_lim = -MAXSHORT
         
         espidf.pcnt_filter_disable(self._unit)
@@ -72,21 +441,509 @@ class PCNTButton(object):
         espidf.pcnt_counter_clear(self._unit)
         espidf.pcnt_counter_resume(self._unit)
     
+    def release(self):
+        if not self._live:
+            return
+        self._live = False
+        u = self._unit
+        if pcntUnits.release(u, self):
+            pcntBank.remove(u)
+            espidf.pcnt_counter_pause(u)
+            espidf.pcnt_counter_clear(u)
+    
     def getCount(self):
-        cnt_ptr = espidf.C_Pointer()
-        espidf.pcnt_get_counter_value(self._unit, cnt_ptr)
-        cnt = cnt_ptr.int_val
-        if cnt>MAXCOUNT or cnt<-MAXCOUNT:
-            self.clearCount()
-        return cnt
+        return pcntBank.readUnit(self._unit)
     
     def clearCount(self):
         espidf.pcnt_counter_clear(self._unit)
     
     @property
     def pressed(self):
-        cnt = self.getCount()
-        return cnt%2==1
+        return pcntBank.count(self._unit)%2==1
+    
+    @property
+    def unitMask(self):
+        return 1<<self._unit
+    
+    def update(self):
+        cnt = pcntBank.count(self._unit)
+        e = cnt-self._last
+        if e<0:
+            # The counter was zeroed in between
+            e = cnt
+        # One edge is the visible change of state (if any), the rest come in pairs
+        t = (e-((cnt^self._last)&1))>>1
+        if t<0:
+            t = 0
+        self._taps = t
+        self._last = cnt
+    
+    @property
+    def taps(self):
+        return self._taps
+
+# The IRQ of a pin, shared by all the IRQButtons on that pin (a GPIO has one IRQ handler). There is one per pin, handed
+# out by irqPins. The ISR writes the edges, time stamped, into a preallocated ring buffer and flags the pin in
+# pcntBank. It only moves the head (a free running count of the edges): each user reads the ring with its own cursor,
+# no lock. A user falling more than RINGSIZE edges behind loses the oldest ones.
+# The pin is pulled up, like the PCNT pulse pins.
+#
+# IRQPin(pinN)
+#
+# Methods:
+# @property head: the number of edges written (EDGEMASK wraps it)
+# time(n), level(n): the time stamp (utime.ticks_us()) and level of edge number n (only the last RINGSIZE are kept)
+# value(): the level of the pin now
+# @property unitMask: the bit of the pin in pcntBank's masks (see PCNTBank.addSource())
+# @property users: the users of the pin
+# close(): stops the IRQ and gives back the bit
+#
+class IRQPin(object):
+    def __init__(self, pinN):
+        self._pinN = pinN
+        self._tEdge = array('l', [0]*RINGSIZE)
+        self._level = bytearray(RINGSIZE)
+        self._head = 0
+        self.users = []
+        self._source = pcntBank.addSource()
+        self._bit = 1<<self._source
+        self._pin = Pin(pinN, Pin.IN, Pin.PULL_UP)
+        self._pin.irq(handler = self._irq, trigger = Pin.IRQ_FALLING|Pin.IRQ_RISING)
+    
+    def __repr__(self):
+        return "IRQPin({})".format(self._pinN)
+    
+    # ISR: keep it short. No allocation
+    def _irq(self, pin):
+        i = self._head&RINGMASK
+        self._tEdge[i] = utime.ticks_us()
+        self._level[i] = pin.value()
+        self._head = (self._head+1)&EDGEMASK
+        pcntBank.flag(self._bit)
+    
+    @property
+    def head(self):
+        return self._head
+    
+    def time(self, n):
+        return self._tEdge[n&RINGMASK]
+    
+    def level(self, n):
+        return self._level[n&RINGMASK]
+    
+    def value(self):
+        return self._pin.value()
+    
+    @property
+    def unitMask(self):
+        return self._bit
+    
+    def close(self):
+        self._pin.irq(handler = None)
+        pcntBank.removeSource(self._source)
+
+# A class that hands out the IRQPins: one per pin, shared by its users (IRQButtons), closed when the last one releases
+# it. There is one: irqPins.
+#
+# IRQPins()
+#
+# Methods:
+# claim(pinN, user): returns the IRQPin of pinN for user (set up if user is its first one)
+# release(pinN, user): user gives pinN back. Returns True if its IRQ was stopped.
+# pinOf(pinN): the IRQPin of pinN (None if none)
+# table(): the pins used as a list of (pin, [owners])
+# report(): prints the table
+#
+class IRQPins(object):
+    def __init__(self):
+        self._pins = {}
+    
+    def claim(self, pinN, user):
+        p = self._pins.get(pinN)
+        if p is None:
+            p = IRQPin(pinN)
+            self._pins[pinN] = p
+        p.users.append(user)
+        return p
+    
+    def release(self, pinN, user):
+        p = self._pins.get(pinN)
+        if p is None or user not in p.users:
+            return False
+        p.users.remove(user)
+        if p.users:
+            return False
+        p.close()
+        del self._pins[pinN]
+        return True
+    
+    def pinOf(self, pinN):
+        return self._pins.get(pinN)
+    
+    def table(self):
+        return [(pinN, [getattr(b, "owner", b) for b in p.users]) for pinN, p in sorted(self._pins.items())]
+    
+    def report(self):
+        for pinN, owners in self.table():
+            print("pin {}: {}".format(pinN, owners))
+
+irqPins = IRQPins()
+
+# A class that reads an IO with a pin IRQ, for when the PCNT units run out. Same interface as PCNTButton.
+# The edges come from the pin's IRQPin (shared with the other IRQButtons on the pin): each button reads them with its
+# own cursor. update() drains the edges since its last update, drops the bounces (a change less than debounce us after
+# the previous one) and checks the result against pin.value(): a missed edge, or edges lost by a full ring, cannot
+# leave the button in the wrong state. That check waits for the debounce time after the last change (the pin may be
+# bouncing): the pin is flagged again, so that the next update does it.
+# The debounce reference is kept within debounce us of the last update, and dropped after STALEMS ms without one:
+# an edge after hours idle is not taken for a bounce (ticks_us() wraps around).
+# The pin is read active low, like the PCNT buttons: pressed is pin.value()==0.
+#
+# IRQButton(pinN, [debounce = DEBOUNCE], [owner = None])
+# owner: the device the button belongs to
+#
+# Methods:
+# @property pressed: the state of the button at the last update()
+# update(): drains the edges since the last update()
+# @property taps: the number of press/release pairs between the last two update()s on top of what pressed shows
+#     (see PCNTButton.taps)
+# @property lastEdge: the time stamp (utime.ticks_us()) of the last change of state
+# @property lost: the number of edges this button missed because it fell more than RINGSIZE edges behind
+# @property unitMask: the bit of the button's pin in pcntBank's masks (see PCNTBank.addSource())
+# release(): gives back the pin (see IRQPins.release()). The button cannot be used after that. A button is a context
+#     manager: it is released at the end of a with block.
+# @property owner: the owner given (the button itself if None)
+#
+class IRQButton(object):
+    def __init__(self, pinN, debounce = DEBOUNCE, owner = None):
+        self._pinN = pinN
+        self._owner = owner
+        self._debounce = debounce
+        self._lost = 0
+        self._taps = 0
+        self._tLast = utime.ticks_us()
+        # Debounce reference (us), and the time of the last update (ms)
+        self._tRef = self._tLast
+        self._msUpd = utime.ticks_ms()
+        self._src = irqPins.claim(pinN, self)
+        self._live = True
+        # The edges before this button are not its own
+        self._cursor = self._src.head
+        self._pressed = self._src.value()==0
+    
+    def __repr__(self):
+        return "IRQButton({})".format(self._pinN)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
+    
+    @property
+    def owner(self):
+        return self if self._owner is None else self._owner
+    
+    def update(self):
+        src = self._src
+        db = self._debounce
+        # Before the head: the edges left for the next update come after now
+        now = utime.ticks_us()
+        ms = utime.ticks_ms()
+        ref = utime.ticks_diff(ms, self._msUpd)<STALEMS
+        self._msUpd = ms
+        s = self._pressed
+        t = 0
+        h = src.head
+        n = (h-self._cursor)&EDGEMASK
+        if n>RINGSIZE:
+            self._lost += n-RINGSIZE
+            n = RINGSIZE
+        i = h-n
+        while n>0:
+            q = src.level(i)==0
+            if q!=s and (not ref or utime.ticks_diff(src.time(i), self._tRef)>=db):
+                s = q
+                t += 1
+                self._tLast = self._tRef = src.time(i)
+                ref = True
+            i += 1
+            n -= 1
+        self._cursor = h
+        # Resync: the bounces dropped, a missed edge. Not while the pin may still be bouncing: flagged for later.
+        q = src.value()==0
+        if q!=s:
+            if not ref or utime.ticks_diff(now, self._tRef)>=db:
+                s = q
+                t += 1
+                self._tLast = self._tRef = now
+            else:
+                pcntBank.flag(src.unitMask)
+        # No older than db: the reference does not wrap around while the updates go on
+        if not ref or utime.ticks_diff(now, self._tRef)>db:
+            self._tRef = utime.ticks_add(now, -db)
+        self._taps = t>>1
+        self._pressed = s
+    
+    @property
+    def pressed(self):
+        return self._pressed
+    
+    @property
+    def taps(self):
+        return self._taps
+    
+    @property
+    def lastEdge(self):
+        return self._tLast
+    
+    @property
+    def lost(self):
+        return self._lost
+    
+    @property
+    def unitMask(self):
+        return self._src.unitMask
+    
+    def release(self):
+        if not self._live:
+            return
+        self._live = False
+        irqPins.release(self._pinN, self)
+
+# Makes the button reading pin pinN for owner: a PCNTButton if the pin is already counted, if unit is given or while
+# there are PCNT units left, an IRQButton after that (sharing the pin's IRQ if it already has one).
+def makeButton(pinN, unit = None, owner = None):
+    if irqPins.pinOf(pinN) is not None and unit is None:
+        return IRQButton(pinN, owner = owner)
+    if unit is not None or pcntUnits.free>0 or pcntUnits.unitOf(pinN) is not None:
+        return PCNTButton(pinN, unit, owner)
+    return IRQButton(pinN, owner = owner)
+
+# A histogram of durations (in us) with fixed-width buckets, in a preallocated array: add() does not allocate.
+#
+# LatencyHistogram([buckets = HISTBUCKETS], [width = HISTWIDTH])
+# buckets: the number of buckets. width: the width of a bucket in us. The last bucket takes everything above
+# (buckets-1)*width.
+#
+# Methods:
+# add(us): records a duration
+# reset(): forgets everything recorded
+# @property count: the number of durations recorded
+# @property min, @property max: the shortest/longest durations recorded (-1 if none)
+# percentile(p): the upper bound (in us) of the bucket holding the p-th percentile (0<p<=100), never more than the
+#     max. The max for the last bucket. -1 if nothing was recorded.
+# report([name = ""]): prints the count, min, max and the 50th, 90th and 99th percentiles
+#
+class LatencyHistogram(object):
+    def __init__(self, buckets = HISTBUCKETS, width = HISTWIDTH):
+        self._n = buckets
+        self._width = width
+        self._h = array('L', [0]*buckets)
+        self.reset()
+    
+    def reset(self):
+        for i in range(self._n):
+            self._h[i] = 0
+        self._count = 0
+        self._min = -1
+        self._max = -1
+    
+    def add(self, us):
+        i = us//self._width
+        if i>=self._n:
+            i = self._n-1
+        elif i<0:
+            i = 0
+        self._h[i] += 1
+        self._count += 1
+        if self._min<0 or us<self._min:
+            self._min = us
+        if us>self._max:
+            self._max = us
+    
+    @property
+    def count(self):
+        return self._count
+    
+    @property
+    def min(self):
+        return self._min
+    
+    @property
+    def max(self):
+        return self._max
+    
+    def percentile(self, p):
+        if self._count==0:
+            return -1
+        acc = 0
+        for i in range(self._n):
+            acc += self._h[i]
+            if acc*100>=p*self._count:
+                break
+        if i==self._n-1:
+            return self._max
+        return min((i+1)*self._width, self._max)
+    
+    def report(self, name = ""):
+        print("{} n: {}, min: {}us, max: {}us, 50%: <={}us, 90%: <={}us, 99%: <={}us".format(name, self._count,
+              self._min, self._max, self.percentile(50), self.percentile(90), self.percentile(99)))
+
+# A ring buffer of input events timings, to follow an event from the hardware to the screen. Each event is
+# (device, detect, deliver, flush), all utime.ticks_us() values:
+#     detect: when the device saw the change (the IRQ for an interrupt driven device, the poll otherwise)
+#     deliver: when the reader handed it to lvgl
+#     flush: when the first display refresh after the delivery was over: lvgl calls the monitor_cb of the display
+#         driver once all the areas of a refresh were drawn and flushed (flush_cb is called for each chunk of it)
+# Preallocated arrays: recording does not allocate.
+#
+# LatencyTracer([size = TRACESIZE])
+# size: the number of events kept. The oldest ones are overwritten.
+#
+# Methods:
+# deliver(dev, detect): records an event of device dev (a small int, see BaseDevice.setTracer()) detected at detect
+#     and handed to lvgl now. Called by the readers.
+# flushed(): stamps the events not flushed yet with the current time. Called by the monitor callback.
+# wrapMonitor([monitor = None]): returns a display monitor callback calling monitor (if any), then flushed(). Set it
+#     as the monitor_cb of the display driver.
+# @property count: the number of events kept
+# get(i): the i-th event kept (0 is the oldest) as a (dev, detect, deliver, flush) tuple. flush is -1 if the event
+#     has not been flushed yet.
+# report(): prints the events kept with the detect->deliver, deliver->flush and detect->flush times (in us)
+# reset(): forgets everything
+#
+class LatencyTracer(object):
+    def __init__(self, size = TRACESIZE):
+        self._size = size
+        self._dev = bytearray(size)
+        self._tDetect = array('l', [0]*size)
+        self._tDeliver = array('l', [0]*size)
+        self._tFlush = array('l', [0]*size)
+        self.reset()
+    
+    def reset(self):
+        self._head = 0
+        self._len = 0
+        self._unflushed = 0
+    
+    def deliver(self, dev, detect):
+        i = self._head
+        self._dev[i] = dev
+        self._tDetect[i] = detect
+        self._tDeliver[i] = utime.ticks_us()
+        i += 1
+        if i==self._size:
+            i = 0
+        self._head = i
+        if self._len<self._size:
+            self._len += 1
+        if self._unflushed<self._size:
+            self._unflushed += 1
+    
+    def flushed(self):
+        n = self._unflushed
+        if n==0:
+            return
+        t = utime.ticks_us()
+        i = self._head
+        while n>0:
+            i -= 1
+            if i<0:
+                i = self._size-1
+            self._tFlush[i] = t
+            n -= 1
+        self._unflushed = 0
+    
+    def wrapMonitor(self, monitor = None):
+        def tracedMonitor(drv, time, px):
+            if monitor is not None:
+                monitor(drv, time, px)
+            self.flushed()
+        return tracedMonitor
+    
+    @property
+    def count(self):
+        return self._len
+    
+    def get(self, i):
+        j = self._head-self._len+i
+        if j<0:
+            j += self._size
+        fl = -1
+        if i<self._len-self._unflushed:
+            fl = self._tFlush[j]
+        return (self._dev[j], self._tDetect[j], self._tDeliver[j], fl)
+    
+    def report(self):
+        for i in range(self._len):
+            dev, det, dlv, fl = self.get(i)
+            if fl<0:
+                print("dev {}: detect->deliver: {}us, not flushed yet".format(dev, utime.ticks_diff(dlv, det)))
+            else:
+                print("dev {}: detect->deliver: {}us, deliver->flush: {}us, detect->flush: {}us".format(dev,
+                      utime.ticks_diff(dlv, det), utime.ticks_diff(fl, dlv), utime.ticks_diff(fl, det)))
+
+# The reader of a pooled indev once its device is released: idle (released, no move). No reference to the device.
+def idleReader(drv, data):
+    data.state = lv.INDEV_STATE.REL
+    data.enc_diff = 0
+    return False
+
+# An lvgl input device registered once and reused: its read_cb goes through reader, which is swapped.
+#
+# IndevSlot(devType, reader)
+# drv: the indev_drv_t, indev: the registered indev, reader: the reader called by lvgl
+#
+class IndevSlot(object):
+    def __init__(self, devType, reader):
+        self.reader = reader
+        self.drv = lv.indev_drv_t()
+        lv.indev_drv_init(self.drv)
+        self.drv.type = devType
+        self.drv.read_cb = lambda drv, data: self.reader(drv, data)
+        self.indev = lv.indev_drv_register(self.drv)
+
+# A class that keeps the lvgl input devices of the released devices, per type, and hands them to the next devices
+# registered. lvgl (v6) cannot unregister an input device: without it, rebuilding the devices over and over would
+# register a new indev each time, read on every tick and keeping its released device alive. There is one:
+# indevPool.
+#
+# IndevPool()
+#
+# Methods:
+# claim(devType, reader): returns an IndevSlot of type devType reading reader: a free one if any, else a new one
+#     (registered with lvgl). A reused indev keeps its lvgl group and button points until they are set again.
+# release(slot): slot reads as idle (idleReader) and is free for the next claim() of its type
+# @property free: the number of free slots
+#
+class IndevPool(object):
+    def __init__(self):
+        self._free = {}
+    
+    def claim(self, devType, reader):
+        free = self._free.get(devType)
+        if free:
+            slot = free.pop()
+            slot.reader = reader
+            return slot
+        return IndevSlot(devType, reader)
+    
+    def release(self, slot):
+        slot.reader = idleReader
+        free = self._free.get(slot.drv.type)
+        if free is None:
+            free = self._free[slot.drv.type] = []
+        free.append(slot)
+    
+    @property
+    def free(self):
+        n = 0
+        for v in self._free.values():
+            n += len(v)
+        return n
+
+indevPool = IndevPool()
 
 # Class creating a generic input device and associated driver
 # This class is mainly virtual.
@@ -99,7 +956,18 @@ class PCNTButton(object):
 # @property pressed: if something is pressed.
 # @property changed: something recently changed.
 # _reader: the callback. Needs to be overridden.
-# getReader(): returns the callback used to register the device.
+# getReader(): returns the callback used to register the device. Timed if enableTiming() was called.
+# enableTiming([buckets = HISTBUCKETS], [width = HISTWIDTH]): times each call of the reader with utime.ticks_us() into a
+#     LatencyHistogram and returns it. Call it before registering the driver: the callback is chosen then, so a device
+#     without timing runs the plain reader (no cost).
+# @property timing: the LatencyHistogram of the reader (None if the timing is off)
+# setTracer(tracer, [dev = 0]): records the events of the device in LatencyTracer tracer as device number dev.
+#     tracer = None turns the tracing off (the default).
+# release(): gives back what the device holds (counters, IRQs, through _release()) and its lvgl indev (to indevPool:
+#     the next device of the same type registered reuses it). The device reads as idle (released, no move) from then
+#     on. A device is a context manager: it is released at the end of a with block. Only the first call does
+#     something: the ids given back (pcntBank subscription...) may belong to a newer device by the next one.
+# _release(): needs to be overridden. Does the work of release(), and drops the device's buffers (keys, queues...)
 #
 # registerDriver(): registers ithe input device and returns the driver
 # extraRegistration(): performs the extra thigns after registration. Needs to be overridden.
@@ -118,6 +986,16 @@ class PCNTButton(object):
 # to reflect the actual device type.
 
 class BaseDevice(object):
+    # No timing by default. Class attribute: the derived classes do not call BaseDevice.__init__
+    _hist = None
+    # No tracing by default. Detection time of the changes not delivered yet (-1: none)
+    _tracer = None
+    _traceId = 0
+    _tDetect = -1
+    _released = False
+    # The IndevSlot of the registered driver
+    _slot = None
+    
     def __init__(self, debug = False):
         self._debug = debug
         self._pressed = False
@@ -151,18 +1029,63 @@ class BaseDevice(object):
         return False
     
     def getReader(self):
+        if self._hist is not None:
+            return self._timed(lambda drv, data: self._reader(drv, data), self._hist)
         return (lambda drv, data: self._reader(drv, data))
     
+    def enableTiming(self, buckets = HISTBUCKETS, width = HISTWIDTH):
+        self._hist = LatencyHistogram(buckets, width)
+        return self._hist
+    
+    @property
+    def timing(self):
+        return self._hist
+    
+    def setTracer(self, tracer, dev = 0):
+        self._tracer = tracer
+        self._traceId = dev
+    
+    # Wraps reader: its duration goes into hist
+    def _timed(self, reader, hist):
+        def timedReader(drv, data):
+            t0 = utime.ticks_us()
+            more = reader(drv, data)
+            hist.add(utime.ticks_diff(utime.ticks_us(), t0))
+            return more
+        return timedReader
+    
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._release()
+        # The readers look _reader up on each call
+        self._reader = self._idleReader
+        if self._slot is not None:
+            indevPool.release(self._slot)
+            self._slot = None
+    
+    def _idleReader(self, drv, data):
+        return idleReader(drv, data)
+    
+# To override
+    def _release(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
+    
 # To override
     def extraRegistration(self):
         pass
     
     def registerDriver(self):
-        self._indev_drv = lv.indev_drv_t()
-        lv.indev_drv_init(self._indev_drv)
-        self._indev_drv.type = self._devType
-        self._indev_drv.read_cb = self.getReader()
-        self._driver = lv.indev_drv_register(self._indev_drv)
+        self._slot = indevPool.claim(self._devType, self.getReader())
+        self._indev_drv = self._slot.drv
+        self._driver = self._slot.indev
         self.extraRegistration()
         return self._driver
     
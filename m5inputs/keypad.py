@@ -1,15 +1,32 @@
-from .base import PCNTButton, BaseDevice
+from .base import makeButton, BaseDevice, pcntBank
 import lvgl as lv
+from array import array
+import utime
+
+from machine import Pin
+from micropython import const
+
+# Default size of the keypad's event queue
+QSIZE = const(16)
+# MatrixKeypad: default number of rows strobed per update, and the most columns (bits of a row's mask)
+ROWSPERTICK = const(2)
+MAXCOLS = const(16)
 
 # Class to simulate a key press using a physical button (aka DigitalInput)
 #
 # KeyButton(pinN, [keyboard = None], [key = None], [unit = None], [debug = False])
 # watches pin number pinN and sends key to keyboard if not None. unit is the PCNT
 # unit (if None, autoatically allocated) and debug is a flag for debug messages.
+# Once the PCNT units are all taken, the pin is read with an IRQ instead (see makeButton() and IRQButton):
+# a keypad can have more keys than there are PCNT units.
 #
 # Methods:
 # @property key: the key code associated with the button.
-# @property pressed: the key is pressed.
+# @property unitMask: the bit of its PCNT unit (see PCNTBank)
+# release(): gives back its counter (or IRQ)
+# @property pressed: the key is pressed (from pcntBank's snapshot).
+# update(): looks for the edges since the last update (see PCNTButton.update())
+# @property taps: the number of taps too short to be seen by pressed (see PCNTButton.taps)
 #
 class KeyButton(object):
     def __init__(self, pinN, keyboard = None, key = None, unit = None, debug = False):
@@ -20,7 +37,7 @@ class KeyButton(object):
         self._keyboard = keyboard
         if self._keyboard:
             self._keyboard.addKey(self)
-        self._cntB = PCNTButton(pinN, unit)
+        self._cntB = makeButton(pinN, unit, keyboard if keyboard else self)
         self._key = key
         if self._debug:
             print("KeyButton Init {}".format(pinN))
@@ -38,61 +55,155 @@ class KeyButton(object):
         self._pressed = self._cntB.pressed
         return self._pressed
     
+    def update(self):
+        self._cntB.update()
+    
+    @property
+    def taps(self):
+        return self._cntB.taps
+    
+    @property
+    def unitMask(self):
+        return self._cntB.unitMask
+    
+    def release(self):
+        self._cntB.release()
+    
 
 # Class making a keyboard input device
 #
-# Keypad([debug = False])
+# Keypad([debug = False], [qSize = QSIZE])
 # creates a keyboard/keypad input device. debug: flag for debugging.
+# qSize: the size of the event queue (number of (key, state) changes waiting for lvgl).
+#
+# The scan fills a preallocated ring buffer of (key, state) events and the reader hands them to lvgl one
+# by one, asking lvgl to read again (returns True) while the queue is not empty: the whole backlog goes
+# in one lvgl tick. Overlapping presses on different keys are all reported.
 #
 # Methods:
 # addKey(key): adds the key KeyButton object to the keyboard
-# update(): does the work. It scans the keys to find the first one that is pressed (if one is)
-#    and updates the various internal variables. Real crappy implementation/name.
-# @property currentKey: the key code currently pressed (or the last pressed)
-# @property pressed: if the current key is pressed
+# update(): does the work. Scans all the keys and queues every change of state since the last scan.
+#    The scan is skipped while none of the keys' counters changed (see PCNTBank.take()) and nothing was left out
+#    of a full queue.
+#    A key tapped faster than the read period is queued as pressed then released. The same goes for a
+#    quick release/press of a held key. If the queue is full, the pending taps are dropped but the
+#    current state of the key will be queued by a later scan.
+# @property currentKey: the key code of the last event handed to lvgl
+# @property pressed: the state of the last event handed to lvgl
 # @property changed: something recently changed in the key: changed key. (de)Pressed key. Cleared to false after read
+# @property pending: the number of events waiting in the queue
+# release(): releases the keys (see BaseDevice.release())
 # getReader(): returns the callback used to register the device.
 class Keypad(BaseDevice):
-    def __init__(self, debug = False):
+    def __init__(self, debug = False, qSize = QSIZE):
         self._key = 0
-        self._pKey = None
         self._pressed = False
         self._debug = debug
         self._changed = False
         self._devType = lv.INDEV_TYPE.KEYPAD
         self._keys = []
+        # State of each key as queued
+        self._kState = bytearray(0)
+        # The event queue
+        self._qKeys = array('I', [0]*qSize)
+        self._qStates = bytearray(qSize)
+        self._qSize = qSize
+        self._qHead = 0
+        self._qLen = 0
+        # lvgl is draining the queue: no scan until it is empty
+        self._more = False
+        self._bankGen = pcntBank.gen
+        self._sub = pcntBank.subscribe()
+        self._units = 0
+        # Changes that did not fit in the queue
+        self._backlog = False
         if self._debug:
             print("Keyboard Init")
 
     def addKey(self, key):
         (self._keys).append(key)
+        self._kState.append(0)
+        self._units = -1
+    
+    def _push(self, key, state):
+        if self._qLen==self._qSize:
+            return False
+        i = self._qHead+self._qLen
+        if i>=self._qSize:
+            i -= self._qSize
+        self._qKeys[i] = key
+        self._qStates[i] = state
+        self._qLen += 1
+        return True
+    
+    def _pop(self):
+        i = self._qHead
+        self._key = self._qKeys[i]
+        self._pressed = self._qStates[i]==1
+        i += 1
+        if i==self._qSize:
+            i = 0
+        self._qHead = i
+        self._qLen -= 1
+        self._changed = True
+    
+    @property
+    def pending(self):
+        return self._qLen
     
     # Override
     def update(self):
-        if self._pressed:
-            # I should not assume a physical key exists !
-            if self._pKey is not None and self._pKey.pressed:
-                self._pressed = True
-                self._changed = False
-            else:
-                self._changed = True
-                self._pressed = False
-        else:
+        self._bankGen = pcntBank.refresh(self._bankGen)
+        if self._units<0:
+            # Keys added since the last scan (their units are not known when addKey() is called)
+            self._units = 0
             for k in self._keys:
-                if k.pressed:
-                    self._changed = True
-                    self._key = k.key
-                    self._pKey = k
-                    self._pressed = True
-            
+                self._units |= k.unitMask
+        if not (pcntBank.take(self._sub)&self._units) and not self._backlog:
+            return
+        q = self._qLen
+        st = self._kState
+        self._backlog = False
+        for i in range(len(self._keys)):
+            k = self._keys[i]
+            k.update()
+            p = 1 if k.pressed else 0
+            # Every tap is two more changes of state
+            n = 2*k.taps+(p^st[i])
+            while n>0 and self._push(k.key, st[i]^1):
+                st[i] ^= 1
+                n -= 1
+            if n>0:
+                # Queue full: the state left behind is queued by the next scans, counters changed or not
+                self._backlog = True
+        if self._tracer is not None and self._qLen!=q:
+            self._tDetect = utime.ticks_us()
             
+    # Override
+    def _release(self):
+        for k in self._keys:
+            k.release()
+        pcntBank.unsubscribe(self._sub)
+        # Nothing kept for the released device
+        self._keys = []
+        self._kState = bytearray(0)
+        self._qKeys = None
+        self._qStates = None
+        self._qLen = 0
+    
     @property
     def currentKey(self):
         return self._key
     
     # Override
     def _reader(self, drv, data):
-        self.update()
+        if not self._more:
+            self.update()
+        if self._qLen>0:
+            self._pop()
+            if self._tracer is not None:
+                self._tracer.deliver(self._traceId, self._tDetect)
+        self._more = self._qLen>0
         data.key = self.currentKey
         if self.pressed:
             data.state = lv.INDEV_STATE.PR
@@ -100,5 +211,121 @@ class Keypad(BaseDevice):
             data.state = lv.INDEV_STATE.REL
         if self._debug and self.changed:
             print("Key reader: [{}] key: {}, state: {}".format(self, data.key, data.state))
+        return self._more
+
+# Class making a keyboard input device out of a key matrix: rows x cols keys on rows+cols pins, no PCNT unit, no IRQ.
+#
+# MatrixKeypad(rows, cols, keys, [rowsPerTick = ROWSPERTICK], [debug = False], [qSize = QSIZE])
+# rows: the pins of the rows (driven, open drain: low when strobed). cols: the pins of the columns (read, pulled up).
+# keys: the key codes, row by row (len(rows)*len(cols) of them). Up to MAXCOLS columns.
+# rowsPerTick: the number of rows strobed by each update(). The matrix is scanned over len(rows)/rowsPerTick reads:
+#     a read costs rowsPerTick*len(cols) pin reads at most, whatever the size of the matrix.
+# debug, qSize: see Keypad
+#
+# The state of the keys is kept as a bitmask of the columns per row. The changes are queued when their row is
+# scanned, in Keypad's queue: same reader, same lvgl keypad device. A tap shorter than a full scan can be missed.
+# Ghosting: without diodes, three keys pressed at three corners of a rectangle make the fourth one look pressed. A
+# row sharing two columns or more with another row is ambiguous: only its releases are queued until it is not. The
+# other rows are only up to date once they have all been strobed since the row changed: the presses in a row read
+# with two columns or more wait until it reads the same on its next strobe (a full scan later).
+# KeyButtons can be added as well (addKey()): they are scanned as by Keypad.
+#
+# Methods:
+# update(): strobes the next rowsPerTick rows and queues their changes
+# @property rowsPerTick, @rowsPerTick.setter: the number of rows strobed by each update()
+# @property scanTicks: the number of updates for a full scan
+# @property ghosts: the number of row scans held back because of ghosting
+# release(): lets the rows go (see BaseDevice.release())
+#
+class MatrixKeypad(Keypad):
+    def __init__(self, rows, cols, keys, rowsPerTick = ROWSPERTICK, debug = False, qSize = QSIZE):
+        if len(cols)>MAXCOLS or len(keys)!=len(rows)*len(cols):
+            raise ValueError("Up to {} columns, and one key per row and column".format(MAXCOLS))
+        Keypad.__init__(self, debug, qSize)
+        self._rows = [Pin(r, Pin.OPEN_DRAIN, value = 1) for r in rows]
+        self._cols = [Pin(c, Pin.IN, Pin.PULL_UP) for c in cols]
+        self._mKeys = array('I', keys)
+        # Columns of each row: as read by its last strobe, and as queued
+        self._raw = array('H', [0]*len(rows))
+        self._queued = array('H', [0]*len(rows))
+        self._rowsPerTick = rowsPerTick
+        self._row = 0
+        self._ghosts = 0
+    
+    @property
+    def rowsPerTick(self):
+        return self._rowsPerTick
+    
+    @rowsPerTick.setter
+    def rowsPerTick(self, value):
+        self._rowsPerTick = value
+    
+    @property
+    def scanTicks(self):
+        return (len(self._rows)+self._rowsPerTick-1)//self._rowsPerTick
+    
+    @property
+    def ghosts(self):
+        return self._ghosts
+    
+    # Row r (columns m) is at a corner of a rectangle of pressed keys
+    def _ghosted(self, r, m):
+        if m&(m-1)==0:
+            return False
+        raw = self._raw
+        for i in range(len(raw)):
+            x = m&raw[i]
+            if i!=r and x&(x-1):
+                return True
         return False
     
+    # Override
+    def update(self):
+        if self._keys:
+            Keypad.update(self)
+        q = self._qLen
+        nr = len(self._rows)
+        nc = len(self._cols)
+        n = self._rowsPerTick if self._rowsPerTick<nr else nr
+        while n>0:
+            n -= 1
+            r = self._row
+            self._row = r+1 if r+1<nr else 0
+            row = self._rows[r]
+            row.value(0)
+            m = 0
+            for c in range(nc):
+                if self._cols[c].value()==0:
+                    m |= 1<<c
+            row.value(1)
+            prev = self._raw[r]
+            self._raw[r] = m
+            ch = m^self._queued[r]
+            if ch==0:
+                continue
+            if m!=prev and m&(m-1):
+                # The other rows may be stale: checked on the next strobe
+                ch &= self._queued[r]
+            elif self._ghosted(r, m):
+                self._ghosts += 1
+                ch &= self._queued[r]
+            k = r*nc
+            for c in range(nc):
+                b = 1<<c
+                if ch&b:
+                    if not self._push(self._mKeys[k+c], 1 if m&b else 0):
+                        break
+                    self._queued[r] ^= b
+        if self._tracer is not None and self._qLen!=q:
+            self._tDetect = utime.ticks_us()
+    
+    # Override
+    def _release(self):
+        Keypad._release(self)
+        for row in self._rows:
+            row.value(1)
+        self._rows = []
+        self._cols = []
+        self._mKeys = None
+        self._raw = None
+        self._queued = None
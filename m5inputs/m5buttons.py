@@ -1,7 +1,8 @@
-from .base import PCNTButton, BaseDevice
+from .base import makeButton, BaseDevice, pcntBank
 import lvgl as lv
 
 from micropython import const
+import utime
 
 # M5Stack button pins
 BUTTON_A_PIN = const(39)
@@ -36,13 +37,23 @@ def getCenter(obj):
 #     if the logical object is None, then point (0,0) will be acted upon.
 # setLinkeButton(btnId, bt): links physical button id bntId (0 for button A etc.) and object bt. Same
 #     idea as above.
+# update(): does the work. Scans the buttons, records every change of state (all the buttons held are tracked)
+#     and reports the first pending one through btn/pressed. The scan is skipped while none of the counters
+#     changed (see PCNTBank.take()).
+# @property btn: the id of the button of the last reported change
+# @property pending: True if some changes are still waiting to be reported
+# release(): releases the buttons (see BaseDevice.release())
+#
+# The reader reports the pending changes one at a time and asks lvgl to read again (returns True) while some
+# are left: simultaneous presses on A/B/C all reach lvgl in the same read cycle.
 #
 class M5Buttons(BaseDevice):
     buttonID = {BUTTON_A_PIN: 0, BUTTON_B_PIN: 1, BUTTON_C_PIN: 2}
     
     def __init__(self, debug = False):
         self._linkedButtons = [None, None, None]
-        self._phyButtons = [PCNTButton(BUTTON_A_PIN), PCNTButton(BUTTON_B_PIN), PCNTButton(BUTTON_C_PIN)]
+        self._phyButtons = [makeButton(BUTTON_A_PIN, owner = self), makeButton(BUTTON_B_PIN, owner = self),
+                            makeButton(BUTTON_C_PIN, owner = self)]
         self._pressed = False
         self._changed = False
         self._bt = 0 # Button zero is special : it is at first supposed to be the released one...
@@ -52,6 +63,15 @@ class M5Buttons(BaseDevice):
         self._devType = lv.INDEV_TYPE.BUTTON
         self._state = 0
         self._left = 0
+        # lvgl is draining the pending changes: no scan until they are all reported
+        self._more = False
+        # Taps too short for a read period: reported as a press/release (or release/press) pair
+        self._tap = 0
+        self._bankGen = pcntBank.gen
+        self._sub = pcntBank.subscribe()
+        self._units = 0
+        for phy in self._phyButtons:
+            self._units |= phy.unitMask
     
     # Name? setLinkedObjects?
     def setLinkedButtons(self, btA, btB, btC):
@@ -79,10 +99,16 @@ class M5Buttons(BaseDevice):
 #         self._bt = bt
     
     def update(self):
-        st = 0
+        self._bankGen = pcntBank.refresh(self._bankGen)
+        if not (pcntBank.take(self._sub)&self._units):
+            self._next()
+            return
         for i in range(N):
             phy = self._phyButtons[i]
+            phy.update()
             m = 1<<i
+            if phy.taps:
+                self._tap = self._tap | m
             if phy.pressed:
                 if not (self._state & m):
                     self._left = self._left | m
@@ -91,6 +117,12 @@ class M5Buttons(BaseDevice):
                 if self._state & m:
                     self._left = self._left | m
                     self._state = self._state & (MASK^m)
+        if self._tracer is not None and self.pending:
+            self._tDetect = utime.ticks_us()
+        self._next()
+    
+    # Reports the first pending change
+    def _next(self):
         for i in range(N):
             m = 1<<i
             if self._left & m:
@@ -102,15 +134,43 @@ class M5Buttons(BaseDevice):
                 else:
                     self._pressed = False
                 return
+            if self._tap & m:
+                # The opposite of the current state first. The current state comes back through _left.
+                self._changed = True
+                self._tap = self._tap & (MASK^m)
+                self._left = self._left | m
+                self._bt = i
+                self._pressed = not (self._state & m)
+                return
         self._changed = False
     
     @property
     def btn(self):
         return self._bt
+    
+    @property
+    def pending(self):
+        return (self._left|self._tap)!=0
         
+    # Override
+    def _release(self):
+        for phy in self._phyButtons:
+            phy.release()
+        pcntBank.unsubscribe(self._sub)
+        # Nothing kept for the released device
+        self._phyButtons = []
+        self._linkedButtons = []
+        self._points = []
+    
     # Override
     def _reader(self, drv, data):
-        self.update()
+        if self._more:
+            self._next()
+        else:
+            self.update()
+        self._more = self.pending
+        if self._tracer is not None and self._changed:
+            self._tracer.deliver(self._traceId, self._tDetect)
         data.btn_id = self._bt
         if self.pressed:
             data.state = lv.INDEV_STATE.PR
@@ -118,7 +178,7 @@ class M5Buttons(BaseDevice):
             data.state = lv.INDEV_STATE.REL
         if self._debug and self.changed:
             print("Button reader: [{}] id: {}, state: {}".format(self, data.btn_id, data.state))
-        return False
+        return self._more
 
     def updatePoints(self):
         if self._driver is None:
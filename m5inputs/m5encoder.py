@@ -1,86 +1,153 @@
-from .base import PCNTButton, BaseDevice
+from .base import makeButton, BaseDevice, pcntBank
 import lvgl as lv
 
 from micropython import const
+import utime
 
 # M5Stack button pins
 BUTTON_A_PIN = const(39)
 BUTTON_B_PIN = const(38)
 BUTTON_C_PIN = const(37)
 
+# Default autorepeat: ms before it starts, and moves per second once it runs
+DELAY = const(400)
+RATE = const(10)
+
 # Class making a encoder input device using the M5Stack's buttons as:
 #    -, previous, left, down: key A
 #    enter: key B
 #    +, next, right, up: key C
 #
-# M5ButtonEncoder([step = 3], [debug = False])
-# creates a button encoder input device. step: number of times a key has to be seen by the reading loop in order to register as a move.
+# M5ButtonEncoder([delay = DELAY], [rate = RATE], [debug = False])
+# creates a button encoder input device. Pressing A/C moves once straight away, then autorepeats after delay ms
+# at rate moves per second. Both are measured with utime.ticks_ms(): they do not depend on lvgl's read period.
 # debug: flag for debugging.
+# The arguments are keyword only: they replace step (the number of reads per move), and an old positional call
+# (M5ButtonEncoder(3)) or step = ... raises a TypeError instead of meaning something else.
 #
 # Methods:
 # update(): does the work. Calculates the current difference and sees if anything has changed.
-# @property diff: the diff sent by the encoder. The higher step is, the longer one has to press A/C to move.
+#     The fraction of a move not yet sent is carried over to the next update.
+#     A tap on A/C shorter than the read period counts as one move. A tap on B is reported as a press, then a release
+#     on the next update. Nothing is scanned while the counters do not change and no autorepeat runs
+#     (see PCNTBank.take()).
+# @property diff: the diff sent by the encoder since the last read.
+# @property delay, @delay.setter: the delay (in ms) before the autorepeat starts
+# @property rate, @rate.setter: the autorepeat rate (moves per second)
 # @property pressed: if the encoder key (key B) is pressed
 # @property changed: something recently changed in encoder: a move, pressed
+# release(): releases the buttons (see BaseDevice.release())
 # getReader(): returns the callback used to register the device.
 #
 class M5ButtonEncoder(BaseDevice):
-    def __init__(self, step = 3, debug = False):
+    def __init__(self, *, delay = DELAY, rate = RATE, debug = False):
         self._debug = debug
-        self.btA = PCNTButton(BUTTON_A_PIN)
-        self.btB = PCNTButton(BUTTON_B_PIN)
-        self.btC = PCNTButton(BUTTON_C_PIN)
+        self.btA = makeButton(BUTTON_A_PIN, owner = self)
+        self.btB = makeButton(BUTTON_B_PIN, owner = self)
+        self.btC = makeButton(BUTTON_C_PIN, owner = self)
         self._changed = False
         self._pressed = False
-        self._step = step
+        self._delay = delay
+        self._rate = rate
         self._diff = 0
+        # Direction held (-1, 0, 1), time from which the autorepeat is counted, and the fraction of a move
+        # (in 1/1000th) not yet sent
+        self._dir = 0
+        self._t = 0
+        self._acc = 0
         self._devType = lv.INDEV_TYPE.ENCODER
         self._group = []
+        self._bankGen = pcntBank.gen
+        self._sub = pcntBank.subscribe()
+        self._units = self.btA.unitMask|self.btB.unitMask|self.btC.unitMask
+    
+    @property
+    def delay(self):
+        return self._delay
+    
+    @delay.setter
+    def delay(self, value):
+        self._delay = value
+    
+    @property
+    def rate(self):
+        return self._rate
+    
+    @rate.setter
+    def rate(self, value):
+        self._rate = value
     
     # Override
     def update(self):
+        self._bankGen = pcntBank.refresh(self._bankGen)
+        if not (pcntBank.take(self._sub)&self._units) and self._dir==0 and self._pressed==self.btB.pressed:
+            return
+        self.btA.update()
+        self.btB.update()
+        self.btC.update()
+        now = utime.ticks_ms()
+        diff = self._diff
         d = 0
-        f = True
         if self.btA.pressed:
             d -= 1
-            f = False
         if self.btC.pressed:
             d += 1
-            f = False
-        self._diff += d
-        if f:
-            self._diff = 0
-        if d!=0:
+        if d!=self._dir:
+            # New press (or release): one move now, the autorepeat starts after delay
+            self._dir = d
+            self._diff += d
+            self._t = utime.ticks_add(now, self._delay)
+            self._acc = 0
+        elif d!=0:
+            dt = utime.ticks_diff(now, self._t)
+            if dt>0:
+                self._t = now
+                self._acc += dt*self._rate
+                n = self._acc//1000
+                if n>0:
+                    self._acc -= n*1000
+                    self._diff += d*n
+        self._diff += self.btC.taps-self.btA.taps
+        if self._diff!=diff:
             self._changed = True
-        if self._pressed!=self.btB.pressed:
+        p = self.btB.pressed
+        if self.btB.taps and p==self._pressed:
+            # The real state comes back on the next update
+            p = not p
+        if self._tracer is not None and (self._pressed!=p or self._diff!=diff):
+            self._tDetect = utime.ticks_us()
+        if self._pressed!=p:
             self._changed = True
-        self._pressed = self.btB.pressed
-        
+        self._pressed = p
         
     @property
     def diff(self):
-        # // behaves mathematicaly, so we have to take care of the sign...
-        di = self._diff
-        if di>0:
-            d = di//self._step
-        else:
-            d = -(-di//self._step)
-        if d!=0:
-            self._diff = 0
-            return d
-        else:
-            return 0
+        d = self._diff
+        self._diff = 0
+        return d
+    
+    # Override
+    def _release(self):
+        self.btA.release()
+        self.btB.release()
+        self.btC.release()
+        pcntBank.unsubscribe(self._sub)
+        # Nothing kept for the released device
+        self.btA = self.btB = self.btC = None
     
     # Override
     def _reader(self, drv, data):
         self.update()
         data.enc_diff = self.diff
+        if self._tracer is not None and self._tDetect>=0:
+            self._tracer.deliver(self._traceId, self._tDetect)
+            self._tDetect = -1
         if self.pressed:
             data.state = lv.INDEV_STATE.PR
         else:
             data.state = lv.INDEV_STATE.REL
         if self._debug and self.changed:
-            print("Encoder reader : [{}] diff: {} (actual: {}), state: {}".format(self, data.enc_diff, self._diff, data.state))
+            print("Encoder reader : [{}] diff: {} (fraction: {}/1000), state: {}".format(self, data.enc_diff, self._acc, data.state))
         return False
 
 # To be removed
@@ -1,4 +1,4 @@
-from .base import BaseDevice
+from .base import BaseDevice, LatencyHistogram, HISTBUCKETS, HISTWIDTH, indevPool
 import lvgl as lv
 
 from micropython import const
@@ -6,28 +6,88 @@ from machine import I2C, Pin
 import utime
 import ustruct
 
-from i2cnavkey import I2CNavKey, triVal, navAddr, UP, DN, LT, RT, CTR, MAXMIN
+from i2cnavkey import I2CNavKey, navAddr, UP, DN, LT, RT, CTR, MAXMIN, mKeys, mEnc, NOEVENT
 
 MIN = 0
 MAX = 15
 STEP = 1
 MOD = MAX-MIN+1
 
+# Bounds of the wide mode: the counter wraps around every 0x10000 detents and the diff is worked out
+# modulo 0x10000. Exact as long as less than 0x8000 detents go by between two polls. Still small ints.
+WMIN = const(-0x8000)
+WMAX = const(0x7FFF)
+WMASK = const(0xFFFF)
+
+# Default acceleration curve: speed (detents/s) above which the wheel accelerates, detents/s for each
+# extra unit of the multiplier, and the largest multiplier
+ACCTHRESHOLD = const(20)
+ACCSLOPE = const(10)
+ACCMAX = const(8)
+# Longest time (ms) between two rotations for the speed to be worked out. Beyond it (or at 0 ms, or for the first
+# rotation), the wheel is slow: ticks_ms() wraps around after days idle.
+ACCWINDOW = const(1000)
+
+# Default fault policy: immediate retries of a failed poll, failed polls in a row before the navkey is considered
+# offline, and the bounds (ms) of the backoff between two failed polls
+RETRIES = const(1)
+TRIP = const(3)
+BACKOFFMIN = const(20)
+BACKOFFMAX = const(2000)
+
+# Default bus time budget (us) of a NavKeyBus tick
+BUDGET = const(2000)
+
+# The lvgl readers sharing the navkey's snapshot
+KEYREADER = const(0)
+ENCREADER = const(1)
+
 # Hardcoded for now.
 keyDict = {UP: lv.KEY.UP, DN: lv.KEY.DOWN, LT: lv.KEY.LEFT, RT: lv.KEY.RIGHT, CTR: lv.KEY.ENTER}
 
 # Class that makes a I2CNavKey a hybrid inout device in lvgl.
 # WIP!
 #
-# NavKey(i2c, [addr = navAddr], [debug=False])
+# NavKey(i2c, [addr = navAddr], [debug=False], [burst = True], [intPin = None], [wide = False], [wait = True])
 # creates an object managing navkey at address adr on i2c bus i2c.
 # i2c: an I2C object describing the bus
 # addr: address of the navkey. By default navAddr=CONST(0x10)
 # debug: flag for... debugging.
+# burst: if True, each poll reads the status and the encoder in one i2c transaction (see I2CNavKey.burstRead()).
+#     If False, the status is read first, and the encoder only if the status says it moved (two transactions).
+# intPin: if not None, the pin number wired to the navkey's INT line. The navkey is programmed to assert INT on key
+#     and encoder events only, an IRQ marks the device dirty, and update() does not touch the bus while the device is idle.
+# wide: if True, the counter runs from WMIN to WMAX and the diff is the difference of two counter values modulo 0x10000:
+#     any number of detents (up to 0x7FFF) between two polls gives the exact diff. If False, the counter runs from MIN to
+#     MAX and the wraparound is guessed from the MAXMIN flag: more than one wrap between two polls gives a wrong diff.
+# wait: if True, the constructor blocks for the reset of the navkey (400us). If False, it only starts the reset and the
+#     first update() after it configures the navkey (see I2CNavKey.startInit()). Several navkeys then reset in parallel.
 #
 # Methods:
 # update(): does the work. Polls the i2c navkey, checks the keys, calculates the current difference and sees if anything has changed.
-# @property diff: the diff sent by the encoder. The higher step is, the longer one has to press A/C to move.
+#     Never raises on a bus error (OSError): see setFaultPolicy().
+# setFaultPolicy([retries = RETRIES], [trip = TRIP], [backoffMin = BACKOFFMIN], [backoffMax = BACKOFFMAX]): what update()
+#     does when the bus fails. A failed poll is retried at once, at most retries times. If it still fails, the navkey
+#     is left alone for backoffMin ms, twice as long after each new failure (at most backoffMax ms): lvgl gets the last
+#     known state meanwhile. After trip failed polls in a row the navkey is offline (the circuit is open): the next
+#     attempts are a non blocking init (I2CNavKey.startInit()). When one goes through, the keys held are released,
+#     the counter is read again as the new reference and the navkey is configured as usual. It is back online once
+#     configured and read: a failure before that starts again with the reset.
+#     The worst case of a tick is 1+retries failed transactions: give the I2C object a short timeout.
+#     In interrupt mode, an outage is only noticed when the navkey is read (INT asserted).
+# @property online: False if the navkey is offline
+# @property failures: the number of failed polls in a row
+# @property needsPoll: False if the navkey is known to be idle (interrupt mode, INT high and no IRQ since the last read, no fault)
+# poll(reader): updates the navkey only if reader (KEYREADER or ENCREADER) has already seen the current snapshot.
+#     Both lvgl readers go through it: when both drivers are registered, the bus is read once per lvgl tick
+#     and the key and encoder readers share the same snapshot (IStatus is cleared on read...).
+#     If the navkey belongs to a NavKeyBus, the bus updates all its navkeys instead (see NavKeyBus.tick()).
+# @property navKey: the I2CNavKey object driving the navkey (bus accounting: navKey.busReport() etc.)
+# @property diff: the diff sent by the encoder since the last read (multiplied by the acceleration, if any).
+# setAcceleration([threshold = ACCTHRESHOLD], [slope = ACCSLOPE], [maxFactor = ACCMAX]): turns the wheel's acceleration on.
+#     The speed v (detents/s) is worked out from the time between two polls that saw a rotation. Above threshold,
+#     each detent counts for 1+(v-threshold)//slope detents, at most maxFactor. threshold = 0 turns it off (the default).
+#     The first rotation, and one more than ACCWINDOW ms after the previous one, count as slow.
 # @property keyPressed: if a key is pressed
 # @property pressed: if the encoder key (key CTR) is pressed
 # @property keyChanged: some key changed
@@ -38,18 +98,28 @@ keyDict = {UP: lv.KEY.UP, DN: lv.KEY.DOWN, LT: lv.KEY.LEFT, RT: lv.KEY.RIGHT, CT
 # getEncoderReader(): returns the callback used to register the encoder device. It is sen by lvgl as an encoder.
 # registerEncoderDriver(): registers the encoder device associated with the navkey
 # getEncoderDriver(): returns the registered encoder driver
+# enableTiming([buckets = HISTBUCKETS], [width = HISTWIDTH]): times both readers (see BaseDevice), each into its own
+#     LatencyHistogram. Returns the key reader's one. The reader polling the bus in a tick pays for the i2c transaction.
+# @property timing: the LatencyHistogram of the key reader (None if the timing is off)
+# @property encoderTiming: the LatencyHistogram of the encoder reader (None if the timing is off)
+# setTracer(tracer, [dev = 0]): traces the events (see BaseDevice). The key events are recorded as device dev, the
+#     encoder ones as dev+1. In interrupt mode, the detection time is the IRQ's.
 # @property keyGroup:
 # keyGroup.setter: getter/setter for the group associated with the keypad device
 # @property encoderGroup:
 # encoderGroup.setter: getter/setter for the group associated with the encoder device
+# release(): stops the INT IRQ and leaves the NavKeyBus, if any: the navkey is not polled any more. Both readers read
+#     as idle from then on (see BaseDevice.release()).
 #
 
 # Should not really be derived from Base device: only pressed is used !
 class NavKey(BaseDevice):
-    def __init__(self, i2c, addr = navAddr, debug = False):
+    def __init__(self, i2c, addr = navAddr, debug = False, burst = True, intPin = None, wide = False, wait = True):
         self._i2c = i2c
         self._addr = addr
         self._debug = debug
+        self._burst = burst
+        self._wide = wide
         self._pressed = False
         self._keyPressed = False
         self._keyChanged = False
@@ -57,40 +127,218 @@ class NavKey(BaseDevice):
         self._key = 0
         self._enc = 0
         self._diff = 0
-        self._nav = I2CNavKey(i2c, addr, debug)
-        self._nav.setEncoderBounds(MIN, MAX, STEP)
+        # Acceleration: off. Time of the last poll that saw a rotation (-1: none yet).
+        self._accThr = 0
+        self._accSlope = ACCSLOPE
+        self._accMax = ACCMAX
+        self._tRot = -1
+        self._nav = I2CNavKey(i2c, addr, debug, wait)
+        if self._wide:
+            self._nav.setEncoderBounds(WMIN, WMAX, STEP)
+        else:
+            self._nav.setEncoderBounds(MIN, MAX, STEP)
+        # Interrupt mode. Dirty at first: whatever is pending has to be read (and cleared).
+        self._dirty = True
+        self._intPin = None
+        if intPin is not None:
+            self._nav.setInterrupts(mKeys|mEnc)
+            self._intPin = Pin(intPin, Pin.IN, Pin.PULL_UP)
+            self._intPin.irq(handler = self._irq, trigger = Pin.IRQ_FALLING)
         self._encDriver = None
         self._keyDriver = None
+        # The IndevSlots of the registered drivers (see indevPool)
+        self._keySlot = None
+        self._encSlot = None
+        self._encHist = None
+        # Tracing: time of the first IRQ since the last read, detection times of the key/encoder changes not
+        # delivered yet (-1: none)
+        self._tIrq = -1
+        self._tKey = -1
+        self._tEnc = -1
+        # Snapshot generation, and the last one seen by each reader
+        self._gen = 0
+        self._seen = [0, 0]
+        # The NavKeyBus scheduling the polls, if any
+        self._bus = None
+        # Faults: failed polls in a row, time of the next attempt (ms), current backoff, counter to be read again
+        self._fails = 0
+        self._tRetry = 0
+        self._resync = False
+        # Offline: re-init started (the reset went through), not configured and polled yet
+        self._reiniting = False
+        self.setFaultPolicy()
+    
+    def poll(self, reader):
+        if self._seen[reader]==self._gen:
+            if self._bus is None:
+                self.update()
+                self._gen = (self._gen+1)&0xFFFF
+            else:
+                self._bus.tick()
+        self._seen[reader] = self._gen
+    
+    def setAcceleration(self, threshold = ACCTHRESHOLD, slope = ACCSLOPE, maxFactor = ACCMAX):
+        self._accThr = threshold
+        self._accSlope = slope if slope>0 else 1
+        self._accMax = maxFactor
+    
+    def _accelerate(self, d):
+        now = utime.ticks_ms()
+        t = self._tRot
+        self._tRot = now
+        if self._accThr<=0 or t<0:
+            return d
+        dt = utime.ticks_diff(now, t)
+        if dt<=0 or dt>ACCWINDOW:
+            return d
+        v = (d if d>0 else -d)*1000//dt
+        if v<=self._accThr:
+            return d
+        f = 1+(v-self._accThr)//self._accSlope
+        if f>self._accMax:
+            f = self._accMax
+        return d*f
+    
+    def setFaultPolicy(self, retries = RETRIES, trip = TRIP, backoffMin = BACKOFFMIN, backoffMax = BACKOFFMAX):
+        self._retries = retries
+        self._trip = trip if trip>0 else 1
+        self._backoffMin = backoffMin
+        self._backoffMax = backoffMax
+        self._backoff = backoffMin
+    
+    @property
+    def online(self):
+        return self._fails<self._trip
+    
+    @property
+    def failures(self):
+        return self._fails
+    
+    # A poll failed (retries included)
+    def _fault(self):
+        self._fails += 1
+        # Whatever was pending has to be read again. A re-init cut short starts again with the reset.
+        self._dirty = True
+        self._reiniting = False
+        delay = self._backoff
+        self._tRetry = utime.ticks_add(utime.ticks_ms(), delay)
+        self._backoff = min(delay*2, self._backoffMax)
+        if self._debug:
+            print("NavKey 0x{:02x}: bus error #{}, next attempt in {}ms".format(self._addr, self._fails, delay))
+    
+    # Back after an outage: the navkey may have been power cycled, the keys released...
+    def _reinit(self):
+        self._nav.startInit()
+        self._reiniting = True
+        self._resync = True
+        self._dirty = True
+        if self._keyPressed:
+            self._keyPressed = False
+            self._keyChanged = True
+        if self._pressed:
+            self._pressed = False
+            self._encChanged = True
+    
+    @property
+    def needsPoll(self):
+        return self._fails>0 or not self._nav.ready or self._intPin is None or self._dirty or not self._intPin.value()
+    
+    # IRQ handler: keep it short
+    def _irq(self, pin):
+        if self._tracer is not None and not self._dirty:
+            self._tIrq = utime.ticks_us()
+        self._dirty = True
     
     def update(self):
-        st = self._nav.getStatus()
-        ke = self._nav.keyEvent()
-        ee = self._nav.encoderEvent()
+        if self._fails and utime.ticks_diff(utime.ticks_ms(), self._tRetry)<0:
+            # Backing off: lvgl gets the last known state
+            return
+        n = self._retries
+        while True:
+            try:
+                if self._fails>=self._trip and not self._reiniting:
+                    self._reinit()
+                polled = self._update()
+                break
+            except OSError:
+                if n<=0:
+                    self._fault()
+                    return
+                n -= 1
+        # Back online once configured and read: not while the reset is still going on
+        if self._fails and polled:
+            self._fails = 0
+            self._reiniting = False
+            self._backoff = self._backoffMin
+    
+    # Returns True if the navkey was read
+    def _update(self):
+        if not self._nav.ready and not self._nav.finishInit():
+            # Still resetting
+            return False
+        if self._intPin is not None:
+            # INT is level: still low if an event came in while the status was being read
+            if not self._dirty and self._intPin.value():
+                return False
+            self._dirty = False
+        # Detection time (if traced): the IRQ if any, the poll otherwise
+        t = self._tIrq
+        self._tIrq = -1
+        if self._tracer is not None and t<0:
+            t = utime.ticks_us()
+        # No allocation: masks and event codes
+        nav = self._nav
+        nav.refresh(self._burst)
+        kc = nav.keyCode()
+        ec = nav.encoderCode()
         # Logic to evolve
         # One might want to add flags to tell what to do with the centre key
         # is that key sending an encoder event, key event or both?
         # For the time beign, it is hardcoded as both...
-        if ke[0]:
-            ev = ke[1]
-            if self._key!=ev[0] or self._keyPressed!=ev[1]:
-                if ev[0]==CTR:
-                    self._pressed = ev[1]
+        if kc!=NOEVENT:
+            k = kc>>1
+            p = (kc&1)==1
+            if self._key!=k or self._keyPressed!=p:
+                if k==CTR:
+                    self._pressed = p
+                    if self._tEnc<0:
+                        self._tEnc = t
                 self._keyChanged = True
-                self._key = ev[0]
-                self._keyPressed = ev[1]
-        if ee[0]:
-            ev = ee[1]
-            enc = self._nav.getEncoder()
+                if self._tKey<0:
+                    self._tKey = t
+                self._key = k
+                self._keyPressed = p
+        # In wide mode, a burst read always brings a fresh counter: no need for the status flags
+        if ec!=NOEVENT or (self._wide and self._burst) or self._resync:
+            if self._burst or ec!=NOEVENT:
+                enc = nav.encoder
+            else:
+                enc = nav.getEncoder()
             d = 0
-            if enc != self._enc:
-                d = enc-self._enc
-                if st[MAXMIN] is True:
-                    d += MOD
-                elif st[MAXMIN] is False:
-                    d -= MOD
-            self._diff = d
+            if self._resync:
+                # After a re-init, the counter starts afresh
+                self._resync = False
+            elif enc != self._enc:
+                if self._wide:
+                    d = ((enc-self._enc-WMIN)&WMASK)+WMIN
+                else:
+                    d = enc-self._enc
+                    if nav.pressedMask&(1<<MAXMIN):
+                        d += MOD
+                    elif nav.releasedMask&(1<<MAXMIN):
+                        d -= MOD
+                d = self._accelerate(d)
+                if self._tEnc<0:
+                    self._tEnc = t
+            # Accumulated: only the encoder reader consumes it
+            self._diff += d
             self._enc = enc
-            self.encChanged = (d!=0)
+            self._encChanged = (d!=0)
+        return True
+    
+    @property
+    def navKey(self):
+        return self._nav
     
     @property
     def diff(self):
@@ -115,7 +363,10 @@ class NavKey(BaseDevice):
         return ch
     
     def _keyReader(self, drv, data):
-        self.update()
+        self.poll(KEYREADER)
+        if self._tracer is not None and self._tKey>=0:
+            self._tracer.deliver(self._traceId, self._tKey)
+            self._tKey = -1
         data.key = keyDict[self._key]
         if self.keyPressed:
             data.state = lv.INDEV_STATE.PR
@@ -126,7 +377,10 @@ class NavKey(BaseDevice):
         return False
     
     def _encReader(self, drv, data):
-        self.update()
+        self.poll(ENCREADER)
+        if self._tracer is not None and self._tEnc>=0:
+            self._tracer.deliver(self._traceId+1, self._tEnc)
+            self._tEnc = -1
         data.enc_diff = self.diff
         if self.pressed:
             data.state = lv.INDEV_STATE.PR
@@ -136,18 +390,45 @@ class NavKey(BaseDevice):
             print("Encoder reader : [{}] diff: {} enc: {}, state: {}".format(self, data.enc_diff, self._enc, data.state))
         return False
         
+    # The readers look _keyReader/_encReader up on each call: release() swaps them
     def getKeyReader(self):
+        if self._hist is not None:
+            return self._timed(lambda drv, data: self._keyReader(drv, data), self._hist)
         return (lambda drv, data: self._keyReader(drv, data))
         
     def getEncoderReader(self):
+        if self._encHist is not None:
+            return self._timed(lambda drv, data: self._encReader(drv, data), self._encHist)
         return (lambda drv, data: self._encReader(drv, data))
+    
+    # Override
+    def _release(self):
+        if self._intPin is not None:
+            self._intPin.irq(handler = None)
+        if self._bus is not None:
+            self._bus._remove(self)
+        self._keyReader = self._idleReader
+        self._encReader = self._idleReader
+        for slot in (self._keySlot, self._encSlot):
+            if slot is not None:
+                indevPool.release(slot)
+        self._keySlot = None
+        self._encSlot = None
+    
+    # Override: one histogram per reader
+    def enableTiming(self, buckets = HISTBUCKETS, width = HISTWIDTH):
+        self._hist = LatencyHistogram(buckets, width)
+        self._encHist = LatencyHistogram(buckets, width)
+        return self._hist
+    
+    @property
+    def encoderTiming(self):
+        return self._encHist
         
     def registerKeyDriver(self):
-        self._keydev_drv = lv.indev_drv_t()
-        lv.indev_drv_init(self._keydev_drv)
-        self._keydev_drv.type = lv.INDEV_TYPE.KEYPAD
-        self._keydev_drv.read_cb = self.getKeyReader()
-        self._keyDriver = lv.indev_drv_register(self._keydev_drv)
+        self._keySlot = indevPool.claim(lv.INDEV_TYPE.KEYPAD, self.getKeyReader())
+        self._keydev_drv = self._keySlot.drv
+        self._keyDriver = self._keySlot.indev
         return self._keyDriver
     
     def getKeyDriver(self):
@@ -156,12 +437,10 @@ class NavKey(BaseDevice):
         return self._keyDriver
 
     def registerEncoderDriver(self):
-        self._encdev_drv = lv.indev_drv_t()
-        lv.indev_drv_init(self._encdev_drv)
-        self._encdev_drv.type = lv.INDEV_TYPE.ENCODER
-        self._encdev_drv.read_cb = self.getEncoderReader()
-        self._encDriver = lv.indev_drv_register(self._encdev_drv)
-        return self._keyDriver
+        self._encSlot = indevPool.claim(lv.INDEV_TYPE.ENCODER, self.getEncoderReader())
+        self._encdev_drv = self._encSlot.drv
+        self._encDriver = self._encSlot.indev
+        return self._encDriver
     
     def getEncoderDriver(self):
         if self._encDriver is None:
@@ -193,3 +472,94 @@ class NavKey(BaseDevice):
             
 
    
+
+# Class scheduling the polls of several navkeys on one i2c bus (the address is set with the solder pads).
+#
+# NavKeyBus(i2c, [budget = BUDGET])
+# i2c: the I2C object of the bus, shared by all the navkeys
+# budget: the bus time (in us, measured with utime.ticks_us()) a tick may spend. Once it is spent, the navkeys left
+#     wait for the next tick (their events stay latched in the navkey). The first navkey needing a poll is always
+#     polled: every tick makes progress.
+#
+# Methods:
+# add([addr = navAddr], [**kw]): creates a NavKey at address addr on the bus (kw: the other arguments of NavKey) and
+#     returns it. Register its drivers as usual.
+# tick(): polls, round-robin, the navkeys that need it (see NavKey.needsPoll) within the budget, and starts a new
+#     snapshot for all of them. Called by the first reader of any of the navkeys in each lvgl tick: one tick per
+#     lvgl tick.
+# @property navKeys: the list of the navkeys (a released navkey leaves it)
+# @property budget, @budget.setter: the bus time budget of a tick (us)
+# @property lastTick: the bus time spent by the last tick (us)
+# @property deferred: the number of ticks that ran out of budget with navkeys still waiting
+#
+# With intPin given to the navkeys, the idle ones cost an IRQ flag and a pin read per tick: the time of a tick grows
+# with the number of navkeys in use, not with the number of navkeys on the bus.
+#
+class NavKeyBus(object):
+    def __init__(self, i2c, budget = BUDGET):
+        self._i2c = i2c
+        self._budget = budget
+        self._navs = []
+        # Round-robin: the navkey the next tick starts with
+        self._next = 0
+        self._lastTick = 0
+        self._deferred = 0
+    
+    def add(self, addr = navAddr, **kw):
+        nav = NavKey(self._i2c, addr, **kw)
+        nav._bus = self
+        self._navs.append(nav)
+        return nav
+    
+    def tick(self):
+        navs = self._navs
+        n = len(navs)
+        i = self._next
+        spent = 0
+        polled = 0
+        for j in range(n):
+            nav = navs[i]
+            if nav.needsPoll:
+                if polled and spent>=self._budget:
+                    self._deferred += 1
+                    break
+                t0 = utime.ticks_us()
+                nav.update()
+                spent += utime.ticks_diff(utime.ticks_us(), t0)
+                polled += 1
+            i += 1
+            if i==n:
+                i = 0
+        self._next = i
+        self._lastTick = spent
+        for nav in navs:
+            nav._gen = (nav._gen+1)&0xFFFF
+    
+    # Called by NavKey.release()
+    def _remove(self, nav):
+        i = self._navs.index(nav)
+        self._navs.pop(i)
+        if self._next>i:
+            self._next -= 1
+        if self._next>=len(self._navs):
+            self._next = 0
+    
+    @property
+    def navKeys(self):
+        return self._navs
+    
+    @property
+    def budget(self):
+        return self._budget
+    
+    @budget.setter
+    def budget(self, value):
+        self._budget = value
+    
+    @property
+    def lastTick(self):
+        return self._lastTick
+    
+    @property
+    def deferred(self):
+        return self._deferred
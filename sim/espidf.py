@@ -0,0 +1,261 @@
+# Host stand-in for the espidf module of the lvgl bindings. Only the pulse counter is there.
+#
+# Every PCNT unit watches its pulse pin on simboard and counts the edges the way the
+# hardware does (pos_mode on rising edges, neg_mode on falling ones, back to 0 on the limits).
+# The events (thresholds, limits, zero) enabled on a unit call its ISR handler, straight from the edge,
+# once the ISR service is installed and the unit's interrupt enabled.
+# Every call into the driver is counted in stats (name -> number of calls). The ISR calls are not.
+#
+# Extra (sim only):
+# simUnit(unit): the internal state of a unit (count, pin, paused...)
+# simFail(name, [err = ESP_FAIL]): the driver function name returns err from now on (and does nothing), as the
+#     bindings report the errors (esp_err_t return codes, no exception). Until simReset().
+# simReset(): back to unconfigured units, and working driver functions
+import simboard
+
+ESP_OK = 0
+ESP_FAIL = -1
+ESP_ERR_NO_MEM = 0x101
+ESP_ERR_INVALID_STATE = 0x103
+
+stats = {}
+
+def _hit(name):
+    stats[name] = stats.get(name, 0)+1
+
+def resetStats():
+    stats.clear()
+
+class PCNT_UNIT:
+    _0 = 0
+    _1 = 1
+    _2 = 2
+    _3 = 3
+    _4 = 4
+    _5 = 5
+    _6 = 6
+    _7 = 7
+    MAX = 8
+
+class PCNT_CHANNEL:
+    _0 = 0
+    _1 = 1
+    MAX = 2
+
+class PCNT_COUNT:
+    DIS = 0
+    INC = 1
+    DEC = 2
+    MAX = 3
+
+class PCNT_MODE:
+    KEEP = 0
+    REVERSE = 1
+    DISABLE = 2
+    MAX = 3
+
+class PCNT_EVT:
+    THRES_1 = 0x04
+    THRES_0 = 0x08
+    L_LIM = 0x10
+    H_LIM = 0x20
+    ZERO = 0x40
+
+class pcnt_config_t(object):
+    def __init__(self):
+        self.pulse_gpio_num = -1
+        self.ctrl_gpio_num = -1
+        self.lctrl_mode = PCNT_MODE.KEEP
+        self.hctrl_mode = PCNT_MODE.KEEP
+        self.pos_mode = PCNT_COUNT.DIS
+        self.neg_mode = PCNT_COUNT.DIS
+        self.counter_h_lim = 0
+        self.counter_l_lim = 0
+        self.unit = 0
+        self.channel = 0
+
+class C_Pointer(object):
+    def __init__(self):
+        self.int_val = 0
+
+class _Unit(object):
+    def __init__(self, n):
+        self.n = n
+        self.pin = -1
+        self.count = 0
+        self.paused = False
+        self.filter = 0
+        self.filterOn = False
+        self.hLim = 0
+        self.lLim = 0
+        self.posMode = PCNT_COUNT.DIS
+        self.negMode = PCNT_COUNT.DIS
+        self.events = 0
+        self.thres0 = 0
+        self.thres1 = 0
+        self.intr = False
+        self.handler = None
+        self.arg = None
+        self.isrs = 0
+
+    def _event(self, evt):
+        if self.events & evt and self.intr and self.handler is not None and _isrService:
+            self.isrs += 1
+            self.handler(self.arg)
+
+    def edge(self, pinN, v):
+        if self.paused:
+            return
+        mode = self.posMode if v else self.negMode
+        if mode == PCNT_COUNT.INC:
+            self.count += 1
+        elif mode == PCNT_COUNT.DEC:
+            self.count -= 1
+        else:
+            return
+        if self.count == self.thres0:
+            self._event(PCNT_EVT.THRES_0)
+        if self.count == self.thres1:
+            self._event(PCNT_EVT.THRES_1)
+        if self.hLim and self.count >= self.hLim:
+            self.count = 0
+            self._event(PCNT_EVT.H_LIM)
+        elif self.lLim and self.count <= self.lLim:
+            self.count = 0
+            self._event(PCNT_EVT.L_LIM)
+        elif self.count == 0:
+            self._event(PCNT_EVT.ZERO)
+
+_units = [_Unit(i) for i in range(PCNT_UNIT.MAX)]
+_isrService = False
+
+def simUnit(unit):
+    return _units[unit]
+
+# The driver functions replaced by simFail(): name -> the real one
+_failing = {}
+
+def simFail(name, err = ESP_FAIL):
+    if name not in _failing:
+        _failing[name] = globals()[name]
+    def failing(*args):
+        _hit(name)
+        return err
+    globals()[name] = failing
+
+def simReset():
+    global _units, _isrService
+    for name, f in _failing.items():
+        globals()[name] = f
+    _failing.clear()
+    for u in _units:
+        if u.pin >= 0:
+            simboard.unwatch(u.pin, u.edge)
+    _units = [_Unit(i) for i in range(PCNT_UNIT.MAX)]
+    _isrService = False
+    resetStats()
+
+def pcnt_unit_config(cfg):
+    _hit("pcnt_unit_config")
+    u = _units[cfg.unit]
+    if u.pin >= 0:
+        simboard.unwatch(u.pin, u.edge)
+    u.pin = cfg.pulse_gpio_num
+    u.posMode = cfg.pos_mode
+    u.negMode = cfg.neg_mode
+    u.hLim = cfg.counter_h_lim
+    u.lLim = cfg.counter_l_lim
+    u.count = 0
+    if u.pin >= 0:
+        simboard.watch(u.pin, u.edge)
+    return ESP_OK
+
+def pcnt_get_counter_value(unit, ptr):
+    _hit("pcnt_get_counter_value")
+    ptr.int_val = _units[unit].count
+    return ESP_OK
+
+def pcnt_counter_pause(unit):
+    _hit("pcnt_counter_pause")
+    _units[unit].paused = True
+    return ESP_OK
+
+def pcnt_counter_resume(unit):
+    _hit("pcnt_counter_resume")
+    _units[unit].paused = False
+    return ESP_OK
+
+def pcnt_counter_clear(unit):
+    _hit("pcnt_counter_clear")
+    _units[unit].count = 0
+    return ESP_OK
+
+def pcnt_set_filter_value(unit, value):
+    _hit("pcnt_set_filter_value")
+    _units[unit].filter = value
+    return ESP_OK
+
+def pcnt_filter_enable(unit):
+    _hit("pcnt_filter_enable")
+    _units[unit].filterOn = True
+    return ESP_OK
+
+def pcnt_filter_disable(unit):
+    _hit("pcnt_filter_disable")
+    _units[unit].filterOn = False
+    return ESP_OK
+
+def pcnt_set_event_value(unit, evt, value):
+    _hit("pcnt_set_event_value")
+    u = _units[unit]
+    if evt == PCNT_EVT.THRES_0:
+        u.thres0 = value
+    elif evt == PCNT_EVT.THRES_1:
+        u.thres1 = value
+    return ESP_OK
+
+def pcnt_event_enable(unit, evt):
+    _hit("pcnt_event_enable")
+    _units[unit].events |= evt
+    return ESP_OK
+
+def pcnt_event_disable(unit, evt):
+    _hit("pcnt_event_disable")
+    _units[unit].events &= ~evt
+    return ESP_OK
+
+def pcnt_intr_enable(unit):
+    _hit("pcnt_intr_enable")
+    _units[unit].intr = True
+    return ESP_OK
+
+def pcnt_intr_disable(unit):
+    _hit("pcnt_intr_disable")
+    _units[unit].intr = False
+    return ESP_OK
+
+def pcnt_isr_service_install(flags):
+    global _isrService
+    _hit("pcnt_isr_service_install")
+    if _isrService:
+        return ESP_ERR_INVALID_STATE
+    _isrService = True
+    return ESP_OK
+
+def pcnt_isr_service_uninstall():
+    global _isrService
+    _hit("pcnt_isr_service_uninstall")
+    _isrService = False
+
+def pcnt_isr_handler_add(unit, handler, arg):
+    _hit("pcnt_isr_handler_add")
+    if not _isrService:
+        return ESP_ERR_INVALID_STATE
+    _units[unit].handler = handler
+    _units[unit].arg = arg
+    return ESP_OK
+
+def pcnt_isr_handler_remove(unit):
+    _hit("pcnt_isr_handler_remove")
+    _units[unit].handler = None
+    return ESP_OK
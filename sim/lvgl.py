@@ -0,0 +1,220 @@
+# Host stand-in for the lvgl (v6) bindings. Just enough for the input devices.
+#
+# Registered input devices are read the way lvgl does it: task_handler() calls the read_cb of
+# every indev in registration order, over and over while it returns True. Every value handed back
+# to lvgl is logged in indev.log as (time in ms, data) where data is a copy of the indev_data_t.
+# If something read changed (key, button, state or a move), the screen is redrawn: the flush_cb of every
+# registered display is called for each band of FLUSHLINES lines (the chunks of a draw buffer, no pixels), then
+# its monitor_cb (if set) with the refresh time (ms) and the number of pixels.
+#
+# Extra (sim only):
+# indevs: the registered input devices
+# displays: the registered display drivers
+# simRead(indev): one lvgl read cycle of indev. Returns the list of data read
+# simReset(): forgets the registered devices and displays
+import utime
+
+class INDEV_TYPE:
+    NONE = 0
+    POINTER = 1
+    KEYPAD = 2
+    BUTTON = 3
+    ENCODER = 4
+
+class INDEV_STATE:
+    REL = 0
+    PR = 1
+
+class KEY:
+    UP = 17
+    DOWN = 18
+    RIGHT = 19
+    LEFT = 20
+    ESC = 27
+    DEL = 127
+    BACKSPACE = 8
+    ENTER = 10
+    NEXT = 9
+    PREV = 11
+    HOME = 2
+    END = 3
+
+class ALIGN:
+    CENTER = 0
+    IN_TOP_LEFT = 1
+    OUT_RIGHT_TOP = 18
+
+class point_t(object):
+    def __init__(self):
+        self.x = 0
+        self.y = 0
+
+class area_t(object):
+    def __init__(self):
+        self.x1 = 0
+        self.y1 = 0
+        self.x2 = 0
+        self.y2 = 0
+
+class obj(object):
+    def __init__(self, parent = None, copy = None):
+        self._x = 0
+        self._y = 0
+        self._w = 100
+        self._h = 50
+
+    def set_size(self, w, h):
+        self._w = w
+        self._h = h
+
+    def set_pos(self, x, y):
+        self._x = x
+        self._y = y
+
+    def align(self, base, align, x = 0, y = 0):
+        self._x = x
+        self._y = y
+
+    def get_coords(self, ar):
+        ar.x1 = self._x
+        ar.y1 = self._y
+        ar.x2 = self._x+self._w-1
+        ar.y2 = self._y+self._h-1
+
+class btn(obj):
+    pass
+
+class label(obj):
+    def set_text(self, txt):
+        self._text = txt
+
+def scr_load(scr):
+    pass
+
+class indev_data_t(object):
+    def __init__(self):
+        self.point = point_t()
+        self.key = 0
+        self.btn_id = 0
+        self.enc_diff = 0
+        self.state = INDEV_STATE.REL
+
+    def copy(self):
+        d = indev_data_t()
+        d.key = self.key
+        d.btn_id = self.btn_id
+        d.enc_diff = self.enc_diff
+        d.state = self.state
+        return d
+
+    def __repr__(self):
+        return "data(key={}, btn_id={}, enc_diff={}, state={})".format(self.key, self.btn_id, self.enc_diff, self.state)
+
+class disp_drv_t(object):
+    def __init__(self):
+        self.hor_res = 320
+        self.ver_res = 240
+        self.buffer = None
+        self.flush_cb = None
+        self.monitor_cb = None
+
+def disp_drv_init(drv):
+    drv.flush_cb = None
+    drv.monitor_cb = None
+
+def disp_flush_ready(drv):
+    pass
+
+class indev_drv_t(object):
+    def __init__(self):
+        self.type = INDEV_TYPE.NONE
+        self.read_cb = None
+        self.user_data = None
+
+def indev_drv_init(drv):
+    drv.type = INDEV_TYPE.NONE
+    drv.read_cb = None
+
+class indev_t(object):
+    def __init__(self, drv):
+        self.driver = drv
+        self.type = drv.type
+        self.read_cb = drv.read_cb
+        self.group = None
+        self.points = None
+        self.log = []
+        self._lastKey = 0
+        self._lastBtn = 0
+        self._lastState = INDEV_STATE.REL
+        self._changed = False
+
+# Lines drawn and flushed at a time: a refresh of a 240 lines screen takes 6 flush_cb calls
+FLUSHLINES = 40
+
+# Guards against a read_cb that never stops asking to be read again
+MAXREADS = 64
+
+indevs = []
+displays = []
+
+def disp_drv_register(drv):
+    displays.append(drv)
+    return drv
+
+def indev_drv_register(drv):
+    indev = indev_t(drv)
+    indevs.append(indev)
+    return indev
+
+def indev_set_group(indev, group):
+    indev.group = group
+
+def indev_set_button_points(indev, points):
+    indev.points = points
+
+def group_create():
+    return []
+
+def group_add_obj(group, o):
+    group.append(o)
+
+def simRead(indev):
+    out = []
+    for i in range(MAXREADS):
+        data = indev_data_t()
+        data.key = indev._lastKey
+        data.btn_id = indev._lastBtn
+        more = indev.read_cb(indev.driver, data)
+        if data.key!=indev._lastKey or data.btn_id!=indev._lastBtn or data.state!=indev._lastState or data.enc_diff:
+            indev._changed = True
+        indev._lastKey = data.key
+        indev._lastBtn = data.btn_id
+        indev._lastState = data.state
+        d = data.copy()
+        indev.log.append((utime.ticks_ms(), d))
+        out.append(d)
+        if not more:
+            break
+    return out
+
+def task_handler():
+    redraw = False
+    for indev in indevs:
+        indev._changed = False
+        simRead(indev)
+        redraw = redraw or indev._changed
+    if redraw:
+        for drv in displays:
+            t0 = utime.ticks_ms()
+            for y in range(0, drv.ver_res, FLUSHLINES):
+                ar = area_t()
+                ar.y1 = y
+                ar.x2 = drv.hor_res-1
+                ar.y2 = min(y+FLUSHLINES, drv.ver_res)-1
+                drv.flush_cb(drv, ar, None)
+            if drv.monitor_cb is not None:
+                drv.monitor_cb(drv, utime.ticks_diff(utime.ticks_ms(), t0), drv.hor_res*drv.ver_res)
+
+def simReset():
+    del indevs[:]
+    del displays[:]
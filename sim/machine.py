@@ -0,0 +1,118 @@
+# Host stand-in for microPython's machine module: Pin and I2C on top of simboard.
+#
+# I2C models the time spent on the bus: every transaction moves the virtual clock forward by
+# the number of bits it puts on the wire (9 per byte, address and register included) at freq.
+# It also counts transactions and bytes in I2C.stats (shared by all the I2C objects: there is
+# only one bus on the sim board).
+#
+import simboard
+import utime
+
+class Pin(object):
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, id, mode = -1, pull = -1, value = None):
+        self._id = id
+        self._handler = None
+        self._mode = -1
+        self.init(mode, pull, value)
+
+    def __repr__(self):
+        return "Pin({})".format(self._id)
+
+    def init(self, mode = -1, pull = -1, value = None):
+        if mode != -1:
+            self._mode = mode
+        if value is not None:
+            self.value(value)
+
+    def value(self, v = None):
+        if v is None:
+            return simboard.level(self._id)
+        if self._mode in (Pin.OUT, Pin.OPEN_DRAIN):
+            simboard.setLevel(self._id, v)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def _edge(self, pinN, v):
+        if v and (self._trigger & Pin.IRQ_RISING):
+            self._handler(self)
+        elif not v and (self._trigger & Pin.IRQ_FALLING):
+            self._handler(self)
+
+    # One handler per GPIO, as on the hardware: the last one set wins (whichever Pin object set it), and
+    # handler = None stops it
+    def irq(self, handler = None, trigger = IRQ_FALLING | IRQ_RISING):
+        prev = simboard.irqs.pop(self._id, None)
+        if prev is not None:
+            simboard.unwatch(self._id, prev._edge)
+            prev._handler = None
+        self._handler = handler
+        self._trigger = trigger
+        if handler is not None:
+            simboard.irqs[self._id] = self
+            simboard.watch(self._id, self._edge)
+
+def disable_irq():
+    return 0
+
+def enable_irq(state = 0):
+    pass
+
+def freq():
+    return 240000000
+
+class I2C(object):
+    stats = {"transactions": 0, "bytes": 0, "errors": 0}
+
+    def __init__(self, id = 0, scl = None, sda = None, freq = 400000, timeout = 50000):
+        self._freq = freq
+
+    @staticmethod
+    def resetStats():
+        for k in I2C.stats:
+            I2C.stats[k] = 0
+
+    def _account(self, nbytes):
+        I2C.stats["transactions"] += 1
+        I2C.stats["bytes"] += nbytes
+        utime.simAdvance(nbytes*9*1000000//self._freq)
+
+    def _device(self, addr):
+        dev = simboard.i2cDevices.get(addr)
+        if dev is None or getattr(dev, "offline", False):
+            # Nobody acknowledged the address
+            I2C.stats["errors"] += 1
+            self._account(1)
+            raise OSError(19)
+        return dev
+
+    def readfrom_mem_into(self, addr, memaddr, buf):
+        dev = self._device(addr)
+        n = len(buf)
+        buf[:] = dev.read(memaddr, n)
+        # address+W, register, address+R then the data
+        self._account(3+n)
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, memaddr, buf)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, memaddr, buf):
+        dev = self._device(addr)
+        dev.write(memaddr, bytes(buf))
+        self._account(2+len(buf))
+
+    def scan(self):
+        return sorted(a for a, d in simboard.i2cDevices.items() if not getattr(d, "offline", False))
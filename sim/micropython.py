@@ -0,0 +1,15 @@
+# Host stand-in for the micropython module.
+
+def const(x):
+    return x
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+# Runs the callback straight away: there is no scheduler on the host.
+def schedule(func, arg):
+    func(arg)
+    return True
+
+def mem_info(verbose = None):
+    pass
@@ -0,0 +1,95 @@
+# Scenario runner: replays timed button/encoder actions against the input devices running on
+# the host stand-ins, and lets one check what lvgl's readers received.
+#
+# fresh(): resets the sim board, peripherals, lvgl and the virtual clock, and forgets the
+# m5inputs/i2cnavkey modules so that the next import starts from scratch (class counters...).
+#
+# Scenario([period = 30])
+# period: lvgl's input read period in ms. task_handler() is called every period ms.
+#
+# Methods:
+# at(t, fn, *args): calls fn(*args) at time t (ms from the start of the run)
+# press(t, pinN)/release(t, pinN): button on pinN pushed/released at t
+# tap(t, pinN, length): pushed at t, released length ms later (can be less than a period)
+# run(duration): runs the scenario for duration ms. Actions falling at the same time as a read
+#     are done first.
+#
+# Checks (on an indev returned by registerDriver() and co):
+# transitions(indev, field): the (field value, state) pairs seen by lvgl, consecutive duplicates removed
+# moves(indev): the sum of all enc_diff handed to lvgl
+# expect(cond, msg): raises AssertionError(msg) if cond is false
+import os
+import sys
+
+SIMDIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(SIMDIR)
+for p in (ROOT, SIMDIR):
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+import espidf
+import lvgl
+import simboard
+import utime
+from machine import I2C
+
+def fresh():
+    simboard.reset()
+    espidf.simReset()
+    lvgl.simReset()
+    utime.simReset()
+    I2C.resetStats()
+    for name in list(sys.modules):
+        if name == "i2cnavkey" or name == "m5inputs" or name.startswith("m5inputs."):
+            del sys.modules[name]
+
+class Scenario(object):
+    def __init__(self, period = 30):
+        self._period = period
+        self._actions = []
+        self._seq = 0
+
+    def at(self, t, fn, *args):
+        self._seq += 1
+        self._actions.append((t, self._seq, fn, args))
+        return self
+
+    def press(self, t, pinN):
+        return self.at(t, simboard.press, pinN)
+
+    def release(self, t, pinN):
+        return self.at(t, simboard.release, pinN)
+
+    def tap(self, t, pinN, length):
+        self.press(t, pinN)
+        return self.release(t+length, pinN)
+
+    def run(self, duration):
+        t0 = utime.simNow()
+        actions = sorted(self._actions, key = lambda a: (a[0], a[1]))
+        i = 0
+        tRead = 0
+        while tRead <= duration:
+            while i < len(actions) and actions[i][0] <= tRead:
+                t, seq, fn, args = actions[i]
+                utime.simAdvance(t0+t*1000-utime.simNow())
+                fn(*args)
+                i += 1
+            utime.simAdvance(t0+tRead*1000-utime.simNow())
+            lvgl.task_handler()
+            tRead += self._period
+
+def transitions(indev, field = "key"):
+    out = []
+    for t, d in indev.log:
+        ev = (getattr(d, field), d.state)
+        if not out or out[-1] != ev:
+            out.append(ev)
+    return out
+
+def moves(indev):
+    return sum(d.enc_diff for t, d in indev.log)
+
+def expect(cond, msg):
+    if not cond:
+        raise AssertionError(msg)
@@ -0,0 +1,697 @@
+# Scenarios for the input devices, replayed on the host stand-ins.
+#
+# python sim/scenarios.py [name...]
+# runs all the scenarios (functions named sc...) or only the ones given, and prints ok/FAIL for each.
+# Exits with 1 if one failed.
+import gc
+import sys
+import traceback
+import weakref
+
+from scenario import Scenario, fresh, transitions, moves, expect
+import lvgl as lv
+import utime
+from machine import I2C
+
+# M5Stack button pins
+A = 39
+B = 38
+C = 37
+
+def scKeypadTaps():
+    fresh()
+    from m5inputs.keypad import KeyButton, Keypad
+    kbd = Keypad()
+    KeyButton(A, keyboard = kbd, key = lv.KEY.PREV)
+    KeyButton(C, keyboard = kbd, key = lv.KEY.NEXT)
+    indev = kbd.registerDriver()
+    # A tap much shorter than the read period, then a quick release/press of a held key
+    Scenario(period = 30).tap(10, A, 3).press(100, C).release(200, C).press(203, C).release(300, C).run(400)
+    expect(transitions(indev)[1:] == [(lv.KEY.PREV, 1), (lv.KEY.PREV, 0), (lv.KEY.NEXT, 1), (lv.KEY.NEXT, 0),
+                                      (lv.KEY.NEXT, 1), (lv.KEY.NEXT, 0)], transitions(indev))
+
+def scKeypadEvents():
+    fresh()
+    import espidf
+    from m5inputs.base import pcntBank
+    from m5inputs.keypad import KeyButton, Keypad
+    expect(pcntBank.enableEvents(), "no PCNT events")
+    kbd = Keypad()
+    KeyButton(A, keyboard = kbd, key = lv.KEY.PREV)
+    KeyButton(C, keyboard = kbd, key = lv.KEY.NEXT)
+    indev = kbd.registerDriver()
+    espidf.resetStats()
+    Scenario(period = 30).tap(10, A, 3).press(100, C).release(200, C).press(203, C).release(300, C).run(2000)
+    expect(transitions(indev)[1:] == [(lv.KEY.PREV, 1), (lv.KEY.PREV, 0), (lv.KEY.NEXT, 1), (lv.KEY.NEXT, 0),
+                                      (lv.KEY.NEXT, 1), (lv.KEY.NEXT, 0)], transitions(indev))
+    # A counter is only read in the ticks where its ISR flagged it: 4 out of ~66
+    expect(espidf.stats == {"pcnt_get_counter_value": 4}, espidf.stats)
+
+def scKeypadEventsFail():
+    # The driver reports its errors as return codes: the ISR service cannot be installed, it is already installed
+    # (fine), a unit's interrupt cannot be enabled (that unit is polled)
+    for fail in ("install", "installed", "intr"):
+        fresh()
+        import espidf
+        from m5inputs.base import pcntBank
+        from m5inputs.keypad import KeyButton, Keypad
+        if fail == "install":
+            espidf.simFail("pcnt_isr_service_install", espidf.ESP_ERR_NO_MEM)
+        elif fail == "installed":
+            espidf.pcnt_isr_service_install(0)
+        else:
+            espidf.simFail("pcnt_intr_enable")
+        ok = pcntBank.enableEvents()
+        expect(ok == (fail != "install") and pcntBank.events == ok, (fail, ok))
+        kbd = Keypad()
+        KeyButton(A, keyboard = kbd, key = lv.KEY.PREV)
+        KeyButton(C, keyboard = kbd, key = lv.KEY.NEXT)
+        indev = kbd.registerDriver()
+        expect(pcntBank.polled == (3 if fail == "intr" else 0), (fail, pcntBank.polled))
+        Scenario(period = 30).tap(10, A, 3).press(100, C).release(200, C).run(400)
+        expect(transitions(indev)[1:] == [(lv.KEY.PREV, 1), (lv.KEY.PREV, 0), (lv.KEY.NEXT, 1), (lv.KEY.NEXT, 0)],
+               (fail, transitions(indev)))
+
+# A press bouncing n times (every 200us) before it settles
+def _bounce(pinN, n):
+    import simboard
+    for i in range(n):
+        simboard.press(pinN)
+        utime.simAdvance(200)
+        simboard.release(pinN)
+        utime.simAdvance(200)
+    simboard.press(pinN)
+
+def scKeypadIrqFallback():
+    fresh()
+    from m5inputs.base import IRQButton
+    from m5inputs.keypad import KeyButton, Keypad
+    kbd = Keypad()
+    pins = (36, 35, 34, 33, 32, 27, 26, 25, 23, 22, 21, 19)
+    keys = [KeyButton(pins[i], keyboard = kbd, key = 65+i) for i in range(len(pins))]
+    indev = kbd.registerDriver()
+    # The PCNT units are all taken after 8 keys
+    expect([isinstance(k._cntB, IRQButton) for k in keys] == [False]*8+[True]*4, keys)
+    s = Scenario(period = 30)
+    for i in range(len(pins)):
+        s.tap(10+40*i, pins[i], 3)
+    # A bouncing press and release on an IRQ key, then a tap shorter than the period on the last one
+    s.at(600, _bounce, pins[9], 3).release(700, pins[9]).tap(800, pins[11], 3)
+    # A read while a press bounces: the pin is high, the state waits for the pin to settle
+    s.at(900, _bounceHigh, pins[10]).press(901, pins[10]).release(1000, pins[10])
+    s.run(1200)
+    expect(transitions(indev)[1:] == sum([[(65+i, 1), (65+i, 0)] for i in range(len(pins))], [])+
+           [(74, 1), (74, 0), (76, 1), (76, 0), (75, 1), (75, 0)], transitions(indev))
+
+# A press, and a bounce back up 200us later: a read right then sees the pin high
+def _bounceHigh(pinN):
+    import simboard
+    simboard.press(pinN)
+    utime.simAdvance(200)
+    simboard.release(pinN)
+
+def scIrqIdleGap():
+    fresh()
+    from m5inputs.base import IRQButton, pcntUnits
+    from m5inputs.keypad import KeyButton, Keypad
+    for u in range(8):
+        pcntUnits.reserve(u, "scenario")
+    kbd = Keypad()
+    KeyButton(36, keyboard = kbd, key = 65)
+    indev = kbd.registerDriver()
+    Scenario(period = 30).run(60)
+    # Idle for minutes (ticks_us() wraps around in 17 min), then a tap shorter than the read period
+    for gap in (300, 600, 900, 3600):
+        utime.simAdvance(gap*1000000)
+        n = len(transitions(indev))
+        Scenario(period = 30).tap(10, 36, 3).run(100)
+        expect(transitions(indev)[n:] == [(65, 1), (65, 0)], (gap, transitions(indev)[n:]))
+    # Updated all along (every 10s), 20 minutes without an edge
+    btn = IRQButton(35)
+    for i in range(120):
+        utime.simAdvance(10000000)
+        btn.update()
+    _bounceHigh(35)
+    utime.simAdvance(3000)
+    btn.update()
+    expect(btn.taps == 1 and not btn.pressed, (btn.taps, btn.pressed))
+
+ROWS = (2, 4, 5, 12, 13)
+COLS = (14, 15, 16, 17, 18, 19, 21, 22)
+
+def _matrix(rowsPerTick):
+    import simmatrix
+    from m5inputs.keypad import MatrixKeypad
+    mat = simmatrix.FakeMatrix(ROWS, COLS)
+    kbd = MatrixKeypad(ROWS, COLS, [65+i for i in range(len(ROWS)*len(COLS))], rowsPerTick = rowsPerTick)
+    return mat, kbd, kbd.registerDriver()
+
+def scMatrixKeypad():
+    fresh()
+    # 40 keys, 2 rows per read: a full scan every 3 reads
+    mat, kbd, indev = _matrix(2)
+    expect(kbd.scanTicks == 3, kbd.scanTicks)
+    s = Scenario(period = 30)
+    s.at(10, mat.press, 4, 7).at(20, mat.press, 0, 0).at(300, mat.release, 4, 7).at(310, mat.release, 0, 0)
+    s.at(500, mat.press, 2, 3).at(600, mat.release, 2, 3)
+    s.run(1000)
+    # Rows 4 and 0 are strobed by the same read
+    expect(transitions(indev)[1:] == [(104, 1), (65, 1), (104, 0), (65, 0), (84, 1), (84, 0)] and kbd.ghosts == 0,
+           transitions(indev))
+
+def scMatrixGhosting():
+    fresh()
+    mat, kbd, indev = _matrix(5)
+    # Three corners of a rectangle: (1, 1) looks pressed. Row 1 is held back until (0, 1) goes.
+    s = Scenario(period = 30)
+    s.at(10, mat.press, 0, 0).at(40, mat.press, 0, 1).at(100, mat.press, 1, 0).at(300, mat.release, 0, 1)
+    s.at(500, mat.release, 0, 0).at(500, mat.release, 1, 0)
+    s.run(700)
+    expect(transitions(indev)[1:] == [(65, 1), (66, 1), (66, 0), (73, 1), (65, 0), (73, 0)] and kbd.ghosts > 0,
+           (transitions(indev), kbd.ghosts))
+    # One row per read: row 1 is strobed with the rectangle before row 0 is strobed again. Neither the ghost (1, 1)
+    # nor (0, 1) get through until (1, 0) goes.
+    fresh()
+    mat, kbd, indev = _matrix(1)
+    s = Scenario(period = 30)
+    s.at(10, mat.press, 0, 0).at(100, mat.press, 1, 0).at(320, mat.press, 0, 1).at(600, mat.release, 1, 0)
+    s.at(900, mat.release, 0, 0).at(900, mat.release, 0, 1)
+    s.run(1200)
+    expect(transitions(indev)[1:] == [(65, 1), (73, 1), (73, 0), (66, 1), (65, 0), (66, 0)] and kbd.ghosts > 0,
+           (transitions(indev), kbd.ghosts))
+
+def scKeypadQueueFull():
+    for events in (False, True):
+        fresh()
+        from m5inputs.base import pcntBank
+        from m5inputs.keypad import KeyButton, Keypad
+        if events:
+            pcntBank.enableEvents()
+        kbd = Keypad(qSize = 2)
+        pins = (36, 35, 34)
+        for i in range(len(pins)):
+            KeyButton(pins[i], keyboard = kbd, key = 65+i)
+        indev = kbd.registerDriver()
+        # Three keys pressed together, then released: the queue takes two changes at a time, the rest comes later
+        s = Scenario(period = 30)
+        for p in pins:
+            s.press(10, p).release(100, p)
+        s.run(400)
+        down = [e for e in transitions(indev)[1:] if e[1]]
+        up = [e for e in transitions(indev)[1:] if not e[1]]
+        expect(sorted(down) == [(65, 1), (66, 1), (67, 1)] and sorted(up) == [(65, 0), (66, 0), (67, 0)],
+               (events, transitions(indev)))
+
+def scIrqSharedPins():
+    fresh()
+    import simboard
+    from m5inputs.base import IRQButton, irqPins
+    from m5inputs.keypad import KeyButton, Keypad
+    from m5inputs.m5buttons import M5Buttons
+    from m5inputs.m5encoder import M5ButtonEncoder
+    kbd = Keypad()
+    for i, p in enumerate((36, 35, 34, 33, 32, 27, 26, 25)):
+        KeyButton(p, keyboard = kbd, key = 65+i)
+    kbd.registerDriver()
+    # No PCNT unit left: both devices read A/B/C through the same pin IRQs
+    bt = M5Buttons()
+    enc = M5ButtonEncoder()
+    bIndev = bt.registerDriver()
+    eIndev = enc.registerDriver()
+    expect(isinstance(enc.btA, IRQButton) and irqPins.table() == [(C, [bt, enc]), (B, [bt, enc]), (A, [bt, enc])],
+           irqPins.table())
+    s = Scenario(period = 30)
+    s.press(10, A).release(100, A).at(200, enc.release).press(300, A).release(400, A)
+    s.run(500)
+    # The encoder released: the IRQs stay on for M5Buttons
+    expect(transitions(bIndev, "btn_id")[1:] == [(0, 1), (0, 0), (0, 1), (0, 0)], transitions(bIndev, "btn_id"))
+    expect(moves(eIndev) == -1, moves(eIndev))
+    expect(irqPins.table() == [(C, [bt]), (B, [bt]), (A, [bt])] and simboard.irqs.keys() == {A, B, C},
+           irqPins.table())
+    bt.release()
+    expect(irqPins.table() == [] and not simboard.irqs, (irqPins.table(), simboard.irqs))
+
+def scKeypadOverlap():
+    fresh()
+    from m5inputs.keypad import KeyButton, Keypad
+    kbd = Keypad()
+    pins = (36, 35, 34, 33)
+    for i in range(len(pins)):
+        KeyButton(pins[i], keyboard = kbd, key = 65+i)
+    indev = kbd.registerDriver()
+    s = Scenario(period = 100)
+    for i in range(len(pins)):
+        s.tap(10+5*i, pins[i], 30)
+    s.run(200)
+    # Everything in the same lvgl tick
+    ticks = set(t for t, d in indev.log if d.state)
+    expect(len(ticks) == 1, ticks)
+    expect(len(transitions(indev)) == 9, transitions(indev))
+
+def scM5ButtonsChord():
+    fresh()
+    from m5inputs.m5buttons import M5Buttons
+    bt = M5Buttons()
+    indev = bt.registerDriver()
+    Scenario(period = 30).press(10, A).press(12, B).press(14, C).release(100, A).release(100, B).release(100, C).run(200)
+    log = [(t, d.btn_id, d.state) for t, d in indev.log]
+    expect((30, 0, 1) in log and (30, 1, 1) in log and (30, 2, 1) in log, log)
+    expect((120, 0, 0) in log and (120, 1, 0) in log and (120, 2, 0) in log, log)
+
+def scM5EncoderAutorepeat():
+    for period in (10, 30, 100):
+        fresh()
+        from m5inputs.m5encoder import M5ButtonEncoder
+        enc = M5ButtonEncoder(delay = 400, rate = 10)
+        indev = enc.registerDriver()
+        # One move, then 10/s after 400ms: 1+6 moves for a ~1s press (whatever the read period), then a tap on A
+        Scenario(period = period).press(0, C).release(1050, C).tap(1500, A, 2).run(2000)
+        expect(moves(indev) == 6, (period, moves(indev)))
+    # The old step argument, positional or not, is refused rather than taken as a delay
+    for args, kw in (((3,), {}), ((), {"step": 3})):
+        try:
+            M5ButtonEncoder(*args, **kw)
+            expect(False, (args, kw))
+        except TypeError:
+            pass
+
+def scM5SharedCounters():
+    fresh()
+    import espidf
+    from m5inputs.base import pcntUnits
+    from m5inputs.m5buttons import M5Buttons
+    from m5inputs.m5encoder import M5ButtonEncoder
+    bt = M5Buttons()
+    enc = M5ButtonEncoder()
+    bIndev = bt.registerDriver()
+    eIndev = enc.registerDriver()
+    # One unit per pin for both devices
+    expect(pcntUnits.table() == [(0, A, [bt, enc]), (1, B, [bt, enc]), (2, C, [bt, enc])], pcntUnits.table())
+    espidf.resetStats()
+    Scenario(period = 30).tap(10, C, 3).tap(100, C, 3).press(200, A).run(300)
+    expect(transitions(bIndev, "btn_id")[1:] == [(2, 1), (2, 0), (2, 1), (2, 0), (0, 1)], transitions(bIndev, "btn_id"))
+    expect(moves(eIndev) == 1, moves(eIndev))
+    # Each counter read once per tick
+    expect(espidf.stats == {"pcnt_get_counter_value": 3*len(eIndev.log)}, espidf.stats)
+    enc.release()
+    expect(pcntUnits.table() == [(0, A, [bt]), (1, B, [bt]), (2, C, [bt])], pcntUnits.table())
+    bt.release()
+    expect(pcntUnits.table() == [] and pcntUnits.free == 8, pcntUnits.table())
+
+def scRebuildDevices():
+    fresh()
+    from m5inputs.base import pcntBank, pcntUnits
+    from m5inputs.keypad import KeyButton, Keypad
+    from m5inputs.m5encoder import M5ButtonEncoder
+    pins = (36, 35, 34, 33, 32, 27, 26, 25, 23, 22)
+    # Switching screens, over and over: a keypad of 10 keys (8 PCNT, 2 IRQ), then the encoder. The indevs of the
+    # released devices are reused (their logs are cleared to check each device).
+    released = []
+    for i in range(50):
+        k = i%len(pins)
+        with Keypad() as kbd:
+            for j in range(len(pins)):
+                KeyButton(pins[j], keyboard = kbd, key = 65+j)
+            indev = kbd.registerDriver()
+            del indev.log[:]
+            Scenario(period = 30).tap(10, pins[k], 3).run(100)
+            expect(transitions(indev)[1:] == [(65+k, 1), (65+k, 0)], (i, transitions(indev)))
+        with M5ButtonEncoder() as enc:
+            eIndev = enc.registerDriver()
+            del eIndev.log[:]
+            Scenario(period = 30).tap(10, C, 3).run(100)
+            expect(moves(eIndev) == 1, (i, moves(eIndev)))
+        released += [weakref.ref(kbd), weakref.ref(enc)]
+    del kbd, enc
+    gc.collect()
+    # Nothing leaked: units, IRQ bits, subscriptions, indevs, the released devices themselves
+    expect(pcntUnits.table() == [] and pcntBank._sources == 0 and pcntBank._dirty == [-1],
+           (pcntUnits.table(), pcntBank._sources, pcntBank._dirty))
+    expect(len(lv.indevs) == 2 and [r for r in released if r() is not None] == [],
+           (len(lv.indevs), len([r for r in released if r() is not None])))
+    # Released twice: the second call must not take the subscription of the keypad built in between
+    from m5inputs.m5buttons import M5Buttons
+    k1 = Keypad()
+    k1.release()
+    k2 = Keypad()
+    k1.release()
+    bt = M5Buttons()
+    indev = bt.registerDriver()
+    Scenario(period = 30).tap(10, A, 3).run(100)
+    expect(transitions(indev)[1:] == [(0, 1), (0, 0)] and k2._sub != bt._sub, (transitions(indev), k2._sub, bt._sub))
+
+def _navKey(**kw):
+    import simnavkey
+    from m5inputs.navkey import NavKey
+    dev = simnavkey.FakeNavKey(intPin = kw.get("intPin"))
+    nav = NavKey(I2C(0), **kw)
+    return dev, nav, nav.getKeyDriver(), nav.getEncoderDriver()
+
+def scNavKeySharedPoll():
+    fresh()
+    import i2cnavkey
+    dev, nav, kIndev, eIndev = _navKey()
+    I2C.resetStats()
+    s = Scenario(period = 30)
+    s.at(10, dev.press, i2cnavkey.UP).at(100, dev.release, i2cnavkey.UP).at(150, dev.rotate, 3)
+    s.run(300)
+    expect(transitions(kIndev) == [(lv.KEY.UP, 0), (lv.KEY.UP, 1), (lv.KEY.UP, 0)], transitions(kIndev))
+    expect(moves(eIndev) == 3, moves(eIndev))
+    # One (burst) transaction per tick for both readers
+    expect(I2C.stats["transactions"] == len(kIndev.log), I2C.stats)
+
+def scNavKeyBurstStats():
+    # Bytes and transactions per poll (addresses included), idle then turning: (burst, idle, turning)
+    polls = []
+    for burst in (False, True):
+        fresh()
+        dev, nav, kIndev, eIndev = _navKey(burst = burst)
+        nav.update()
+        I2C.resetStats()
+        nav.update()
+        idle = (I2C.stats["transactions"], I2C.stats["bytes"])
+        dev.rotate(1)
+        I2C.resetStats()
+        nav.update()
+        polls.append((burst, idle, (I2C.stats["transactions"], I2C.stats["bytes"])))
+    # An idle poll grows from 5 to 11 bytes with burst, a poll of a move goes from 2 transactions to 1
+    expect(polls == [(False, (1, 5), (2, 12)), (True, (1, 11), (1, 11))], polls)
+
+def scNavKeyIdleWithInt():
+    fresh()
+    dev, nav, kIndev, eIndev = _navKey(intPin = 25)
+    I2C.resetStats()
+    Scenario(period = 30).at(1000, dev.rotate, -2).run(3000)
+    expect(moves(eIndev) == -2, moves(eIndev))
+    # The pending status at start, then the rotation
+    expect(I2C.stats["transactions"] == 2, I2C.stats)
+
+def scNavKeyAcceleration():
+    fresh()
+    dev, nav, kIndev, eIndev = _navKey()
+    nav.setAcceleration()
+    def turns(rotations, duration):
+        n = moves(eIndev)
+        s = Scenario(period = 30)
+        for t, d in rotations:
+            s.at(t, dev.rotate, d)
+        s.run(duration)
+        return moves(eIndev)-n
+    # The first detent after start up, then slow turns (one every 300ms): 1x
+    expect(turns([(10, 1)], 100) == 1, moves(eIndev))
+    expect(turns([(300, 1), (600, 1), (900, -1)], 1000) == 1, moves(eIndev))
+    # One detent per poll (33/s): 2x after the first one. Three per poll (100/s): maxFactor
+    expect(turns([(10, 1), (40, 1), (70, 1)], 100) == 5, moves(eIndev))
+    utime.simAdvance(2000000)
+    expect(turns([(10, 3), (40, 3)], 100) == 3+3*8, moves(eIndev))
+    # A week idle (ticks_ms() wrapped around): 1x
+    utime.simAdvance(7*24*3600*1000000)
+    expect(turns([(10, 1)], 100) == 1, moves(eIndev))
+
+def scNavKeyWide():
+    fresh()
+    dev, nav, kIndev, eIndev = _navKey(wide = True)
+    Scenario(period = 500).at(10, dev.rotate, 5000).at(600, dev.rotate, -20000).run(1000)
+    expect(moves(eIndev) == -15000, moves(eIndev))
+
+def scNavKeyBusStats():
+    fresh()
+    dev, nav, kIndev, eIndev = _navKey()
+    I2C.resetStats()
+    nav.navKey.resetBusStats()
+    Scenario(period = 30).at(100, dev.rotate, 3).run(2000)
+    n, b, err, ms = nav.navKey.busStats()
+    expect(n == I2C.stats["transactions"] and err == 0, (nav.navKey.busStats(), I2C.stats))
+    # One burst (11 bytes with the addresses) per tick at 400kHz: ~0.25ms every 30ms
+    expect(nav.navKey.utilization == 8 and 33 <= nav.navKey.rate <= 34, (nav.navKey.utilization, nav.navKey.rate))
+    # A failed poll and its retry
+    dev.offline = True
+    nav.update()
+    expect(nav.navKey.busStats()[2] == 2, nav.navKey.busStats())
+
+def scNavKeyRelease():
+    fresh()
+    import simboard
+    import simnavkey
+    from m5inputs.navkey import NavKeyBus
+    bus = NavKeyBus(I2C(0))
+    devs = [simnavkey.FakeNavKey(addr = 0x10+i, intPin = 25+i) for i in range(2)]
+    navs = [bus.add(0x10+i, intPin = 25+i) for i in range(2)]
+    indevs = [(nav.getKeyDriver(), nav.getEncoderDriver()) for nav in navs]
+    navs[0].release()
+    # No IRQ, out of the bus: the released navkey is not read any more, its readers are idle
+    expect(bus.navKeys == [navs[1]] and 25 not in simboard.irqs and 26 in simboard.irqs,
+           (bus.navKeys, simboard.irqs))
+    I2C.resetStats()
+    Scenario(period = 30).at(100, devs[0].rotate, 2).at(100, devs[1].rotate, 3).run(500)
+    expect([moves(e) for k, e in indevs] == [0, 3] and I2C.stats["transactions"] == 2, ([moves(e) for k, e in indevs], I2C.stats))
+
+def scNavKeyBusInt():
+    fresh()
+    import simnavkey
+    from m5inputs.navkey import NavKeyBus
+    bus = NavKeyBus(I2C(0))
+    pins = (25, 26, 27, 32)
+    devs = [simnavkey.FakeNavKey(addr = 0x10+i, intPin = pins[i]) for i in range(len(pins))]
+    navs = [bus.add(0x10+i, intPin = pins[i]) for i in range(len(pins))]
+    indevs = [(nav.getKeyDriver(), nav.getEncoderDriver()) for nav in navs]
+    I2C.resetStats()
+    Scenario(period = 30).at(1000, devs[2].rotate, 4).run(2000)
+    expect([moves(e) for k, e in indevs] == [0, 0, 4, 0], [moves(e) for k, e in indevs])
+    # The pending status of each navkey at start, then the rotation: the idle ones cost nothing
+    expect(I2C.stats["transactions"] == len(pins)+1, I2C.stats)
+
+def scNavKeyBusBudget():
+    fresh()
+    import simnavkey
+    from m5inputs.navkey import NavKeyBus
+    # A budget too small for more than one navkey per tick: they are polled in turn
+    bus = NavKeyBus(I2C(0), budget = 1)
+    devs = [simnavkey.FakeNavKey(addr = 0x10+i) for i in range(3)]
+    navs = [bus.add(0x10+i) for i in range(3)]
+    indevs = [(nav.getKeyDriver(), nav.getEncoderDriver()) for nav in navs]
+    I2C.resetStats()
+    s = Scenario(period = 30)
+    for i in range(3):
+        s.at(100, devs[i].rotate, i+1)
+    s.run(300)
+    expect([moves(e) for k, e in indevs] == [1, 2, 3], [moves(e) for k, e in indevs])
+    expect(I2C.stats["transactions"] == len(indevs[0][0].log) and bus.deferred > 0, (I2C.stats, bus.deferred))
+
+def scNavKeyLazyInit():
+    fresh()
+    import simnavkey
+    from m5inputs.navkey import NavKeyBus
+    bus = NavKeyBus(I2C(0))
+    devs = [simnavkey.FakeNavKey(addr = 0x10+i, intPin = 25+i) for i in range(3)]
+    t0 = utime.simNow()
+    navs = [bus.add(0x10+i, intPin = 25+i, wide = True, wait = False) for i in range(3)]
+    # Only the resets went out: no waiting
+    expect(I2C.stats["transactions"] == 3 and utime.simNow()-t0 < 400, (I2C.stats, utime.simNow()-t0))
+    expect(not any(nav.navKey.ready for nav in navs), "ready too early")
+    indevs = [nav.getEncoderDriver() for nav in navs]
+    Scenario(period = 30).at(100, devs[1].rotate, -3).run(300)
+    expect(all(nav.navKey.ready for nav in navs), "not ready")
+    expect([d.reg(0x0E, 12) == bytes.fromhex("00007fffffff800000000001") and d.reg(0x00, 1) == b"\x02" for d in devs] == [True]*3,
+           [d.reg(0, 26) for d in devs])
+    expect([moves(e) for e in indevs] == [0, -3, 0], [moves(e) for e in indevs])
+
+def scNavKeyBoundsWrites():
+    fresh()
+    dev, nav, kIndev, eIndev = _navKey()
+    Scenario(period = 30).run(100)
+    navKey = nav.navKey
+    expect(navKey.ready, "not ready")
+    # Each write: address+W and the register (2 bytes), then the data
+    def writes(min, max, step):
+        I2C.resetStats()
+        navKey.setEncoderBounds(min, max, step)
+        return (I2C.stats["transactions"], I2C.stats["bytes"]-2*I2C.stats["transactions"])
+    # The same bounds (NavKey's 0..15): nothing to write
+    expect(writes(0, 15, 1) == (0, 0), I2C.stats)
+    # CMin only (the middle register)
+    expect(writes(-5, 15, 1) == (1, 4), I2C.stats)
+    expect(dev.reg(0x0E, 12) == bytes.fromhex("0000000ffffffffb00000001"), dev.reg(0x0E, 12))
+    # CMax and IStep: one write across CMin
+    expect(writes(-5, 5, 2) == (1, 12), I2C.stats)
+    expect(dev.reg(0x0E, 12) == bytes.fromhex("00000005fffffffb00000002"), dev.reg(0x0E, 12))
+    expect(writes(-5, 5, 2) == (0, 0), I2C.stats)
+
+# The status decoding (tables, masks, codes) against the one it replaced (triVal() per state), for every status word
+def scNavKeyDecode():
+    fresh()
+    import i2cnavkey as nk
+    import simnavkey
+    simnavkey.FakeNavKey()
+    navKey = nk.I2CNavKey(I2C(0), wait = False)
+    def first(st, keys):
+        for k in keys:
+            if st[k] is not None:
+                return (True, (k, st[k]))
+        return (False, None)
+    for fl in range(1<<15):
+        old = [nk.triVal(fl&nk.fUPP, fl&nk.fUPR), nk.triVal(fl&nk.fDNP, fl&nk.fDNR), nk.triVal(fl&nk.fLTP, fl&nk.fLTR),
+               nk.triVal(fl&nk.fRTP, fl&nk.fRTR), nk.triVal(fl&nk.fCTRP, fl&nk.fCTRR), nk.triVal(fl&nk.fCTRDP, 0),
+               nk.triVal(fl&nk.fRInc, fl&nk.fRDec), nk.triVal(fl&nk.fRMax, fl&nk.fRMin)]
+        navKey.decodeStatus(fl)
+        new = list(navKey._fillStatus())
+        expect(new == old, (hex(fl), new, old))
+        ev = first(old, (nk.UP, nk.DN, nk.LT, nk.RT, nk.CTR, nk.CTRD))
+        c = navKey.keyCode()
+        expect((c == nk.NOEVENT and not ev[0]) or (c>>1, (c&1) == 1) == ev[1], (hex(fl), c, ev))
+        expect(navKey.keyEvent() == ev, (hex(fl), navKey.keyEvent(), ev))
+        expect(navKey.encoderEvent() == first(old, (nk.ROT, nk.MAXMIN)), (hex(fl), navKey.encoderEvent()))
+
+def _offline(dev, flag):
+    dev.offline = flag
+
+def scNavKeyOutage():
+    for intPin in (None, 25):
+        fresh()
+        import i2cnavkey
+        dev, nav, kIndev, eIndev = _navKey(intPin = intPin)
+        I2C.resetStats()
+        s = Scenario(period = 30)
+        # UP held when the cable comes loose, released (and lost) during the outage
+        s.at(100, dev.press, i2cnavkey.UP).at(300, _offline, dev, True).at(500, dev.release, i2cnavkey.UP)
+        s.at(1500, _offline, dev, False).at(3000, dev.rotate, 5)
+        s.run(3500)
+        # The last known state while offline, released after the re-init (power up, init, re-init), and the counter
+        # still right
+        expect(transitions(kIndev) == [(lv.KEY.UP, 0), (lv.KEY.UP, 1), (lv.KEY.UP, 0)], (intPin, transitions(kIndev)))
+        expect(moves(eIndev) == 5 and dev.resets == 3 and nav.online, (intPin, moves(eIndev), dev.resets))
+        # Backoff: a handful of attempts (with one retry each) over the 1.2s outage
+        expect(I2C.stats["errors"] <= 12, (intPin, I2C.stats))
+
+def scNavKeyReinit():
+    for intPin in (None, 25):
+        fresh()
+        dev, nav, kIndev, eIndev = _navKey(intPin = intPin)
+        dev.offline = True
+        # In interrupt mode, the outage is seen when the navkey is read
+        dev.rotate(1)
+        while nav.online:
+            utime.simAdvance(100000)
+            nav.update()
+        # Back: the reset goes through, the navkey is offline until it is configured and read
+        dev.offline = False
+        resets = dev.resets
+        utime.simAdvance(1000000)
+        nav.update()
+        expect(dev.resets == resets+1 and not nav.online, (intPin, dev.resets, nav.online))
+        # Gone again before the configuration: a new reset on the next attempt
+        dev.offline = True
+        utime.simAdvance(1000)
+        nav.update()
+        dev.offline = False
+        utime.simAdvance(1000000)
+        nav.update()
+        expect(dev.resets == resets+2 and not nav.online, (intPin, dev.resets, nav.online))
+        utime.simAdvance(1000)
+        nav.update()
+        expect(nav.online and nav.failures == 0 and nav.navKey.ready, (intPin, nav.online, nav.failures))
+
+def scLatencyHistogram():
+    fresh()
+    from m5inputs.base import BaseDevice, LatencyHistogram
+    # Buckets [0, 100), [100, 200), [200, 300) and [300, ...)
+    h = LatencyHistogram(4, 100)
+    expect(h.count == 0 and h.min == -1 and h.max == -1 and h.percentile(50) == -1, (h.count, h.min, h.max))
+    h.add(120)
+    # The bound of the bucket, never more than the max
+    expect(h.percentile(50) == 120, h.percentile(50))
+    for us in (50, 150, 250, 1000, 5000):
+        h.add(us)
+    expect(h.count == 6 and h.min == 50 and h.max == 5000, (h.count, h.min, h.max))
+    # The durations above 300us overflow into the last bucket, whose percentiles are the max
+    pc = [h.percentile(p) for p in (10, 20, 50, 60, 70, 99, 100)]
+    expect(pc == [100, 200, 200, 300, 5000, 5000, 5000], pc)
+    h.reset()
+    expect(h.count == 0 and h.min == -1 and h.max == -1 and h.percentile(99) == -1, (h.count, h.min, h.max))
+    h.add(250)
+    expect(h.count == 1 and h.min == 250 and h.max == 250 and h.percentile(50) == 250, (h.count, h.min, h.max))
+
+    # A reader taking known (virtual) times: 50, 150, 250 then 400us
+    class SlowDevice(BaseDevice):
+        def __init__(self, durations):
+            self._pressed = False
+            self._changed = False
+            self._devType = lv.INDEV_TYPE.KEYPAD
+            self._durations = durations
+        def _reader(self, drv, data):
+            utime.sleep_us(self._durations.pop(0))
+            return False
+    dev = SlowDevice([50, 150, 250, 400])
+    expect(dev.timing is None, dev.timing)
+    hist = dev.enableTiming(4, 100)
+    expect(dev.timing is hist, dev.timing)
+    dev.registerDriver()
+    Scenario(period = 30).run(90)
+    pc = [hist.percentile(p) for p in (25, 50, 75, 100)]
+    expect(hist.count == 4 and hist.min == 50 and hist.max == 400 and pc == [100, 200, 300, 400], (hist.count,
+           hist.min, hist.max, pc))
+
+# A display whose flush takes flushUs us per chunk (SPI transfer), with its refreshes traced by tracer
+def _display(tracer, flushUs):
+    def flush(drv, area, buf):
+        utime.sleep_us(flushUs)
+        lv.disp_flush_ready(drv)
+    drv = lv.disp_drv_t()
+    lv.disp_drv_init(drv)
+    drv.flush_cb = flush
+    drv.monitor_cb = tracer.wrapMonitor()
+    return lv.disp_drv_register(drv)
+
+def scTraceKeypad():
+    fresh()
+    from m5inputs.base import LatencyTracer
+    from m5inputs.keypad import KeyButton, Keypad
+    tracer = LatencyTracer()
+    _display(tracer, 5000)
+    kbd = Keypad()
+    KeyButton(A, keyboard = kbd, key = lv.KEY.PREV)
+    kbd.setTracer(tracer, 3)
+    kbd.registerDriver()
+    # The tap is seen by the read at 30ms: press and release delivered then, and on screen once the 6 chunks of the
+    # refresh were flushed, 30ms later
+    Scenario(period = 30).tap(10, A, 3).run(100)
+    ev = [tracer.get(i) for i in range(tracer.count)]
+    expect(ev == [(3, 30000, 30000, 60000), (3, 30000, 30000, 60000)], ev)
+
+def scTraceNavKeyInt():
+    fresh()
+    import i2cnavkey
+    import simnavkey
+    from m5inputs.base import LatencyTracer
+    from m5inputs.navkey import NavKey
+    tracer = LatencyTracer()
+    _display(tracer, 5000)
+    dev = simnavkey.FakeNavKey(intPin = 25)
+    nav = NavKey(I2C(0), intPin = 25)
+    nav.setTracer(tracer, 1)
+    nav.getKeyDriver()
+    nav.getEncoderDriver()
+    # The navkey's init took some (virtual) time
+    t0 = utime.ticks_us()
+    Scenario(period = 30).at(100, dev.rotate, 2).at(200, dev.press, i2cnavkey.UP).run(300)
+    ev = [tracer.get(i) for i in range(tracer.count)]
+    # Detected by the IRQ, delivered by the next read (after the i2c transaction), then flushed
+    expect([(e[0], e[1]-t0) for e in ev] == [(2, 100000), (1, 200000)], ev)
+    expect(all(e[2]>e[1] and e[3]==e[2]+6*5000 for e in ev), ev)
+
+def main(names):
+    failed = 0
+    for name in sorted(n for n in globals() if n.startswith("sc")):
+        if names and name not in names:
+            continue
+        try:
+            globals()[name]()
+            print("ok   {}".format(name))
+        except Exception:
+            failed += 1
+            print("FAIL {}".format(name))
+            traceback.print_exc()
+    return failed
+
+if __name__ == "__main__":
+    sys.exit(1 if main(sys.argv[1:]) else 0)
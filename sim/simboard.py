@@ -0,0 +1,71 @@
+# The simulated board: pin levels, who watches them, and the devices on the i2c bus.
+#
+# Pins idle high (the M5Stack buttons are pulled up and pressing them pulls the pin low).
+#
+# Functions:
+# level(pinN): the current level of pin pinN
+# setLevel(pinN, v): sets the level of pinN and notifies the watchers if it changed
+# press(pinN)/release(pinN): pulls pinN low/lets it go high
+# watch(pinN, cb)/unwatch(pinN, cb): cb(pinN, level) is called on every change of level of pinN
+# resolve(pinN, fn): the level of pinN is computed by fn() (used for wired logic, eg a key matrix)
+# refresh(pinN): re-evaluates a resolved pin and notifies the watchers if its level changed
+# reset(): back to a pristine board
+#
+# irqs: pin -> the Pin object whose IRQ handler is set on it (one per pin)
+# i2cDevices: address -> fake device. A device implements read(mem, n) -> bytes and write(mem, data).
+#
+_levels = {}
+_watchers = {}
+_resolvers = {}
+_seen = {}
+irqs = {}
+i2cDevices = {}
+
+def level(pinN):
+    r = _resolvers.get(pinN)
+    if r is not None:
+        return r()
+    return _levels.get(pinN, 1)
+
+def _notify(pinN, v):
+    for cb in list(_watchers.get(pinN, ())):
+        cb(pinN, v)
+
+def setLevel(pinN, v):
+    v = 1 if v else 0
+    old = level(pinN)
+    _levels[pinN] = v
+    if pinN not in _resolvers and old != v:
+        _notify(pinN, v)
+
+def press(pinN):
+    setLevel(pinN, 0)
+
+def release(pinN):
+    setLevel(pinN, 1)
+
+def watch(pinN, cb):
+    _watchers.setdefault(pinN, []).append(cb)
+
+def unwatch(pinN, cb):
+    l = _watchers.get(pinN)
+    if l is not None and cb in l:
+        l.remove(cb)
+
+def resolve(pinN, fn):
+    _resolvers[pinN] = fn
+    _seen[pinN] = fn()
+
+def refresh(pinN):
+    v = level(pinN)
+    if _seen.get(pinN, v) != v:
+        _seen[pinN] = v
+        _notify(pinN, v)
+
+def reset():
+    _levels.clear()
+    _watchers.clear()
+    _resolvers.clear()
+    _seen.clear()
+    irqs.clear()
+    i2cDevices.clear()
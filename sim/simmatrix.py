@@ -0,0 +1,58 @@
+# A key matrix on the simulated board: rows x cols keys, each joining a row and a column when pressed, no diodes.
+#
+# The rows are driven by the device (open drain: low when strobed, else let go), the columns are pulled up and read.
+# A column reads low if a pressed key joins it to a low row. Without diodes, a low column pulls down the rows joined
+# to it by other pressed keys, and so on: three keys pressed at three corners of a rectangle make the fourth one
+# look pressed (ghosting), as on the real thing.
+# The levels of the columns are worked out when a row or a key changes (not on each read: the benchmarks measure
+# the device, not the stand-in).
+#
+# FakeMatrix(rows, cols): rows, cols: the pin numbers
+#
+# Methods:
+# press(r, c)/release(r, c): presses/releases the key at row r, column c
+# releaseAll(): releases every key
+import simboard
+
+class FakeMatrix(object):
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        # Columns joined to each row by the keys pressed, and the columns low
+        self._keys = [0]*len(rows)
+        self._low = 0
+        for r in rows:
+            simboard.watch(r, self._update)
+        for c in range(len(cols)):
+            simboard.resolve(cols[c], self._resolver(c))
+
+    def _resolver(self, c):
+        return lambda: 0 if self._low & (1 << c) else 1
+
+    def _update(self, *args):
+        lowRows = 0
+        for r in range(len(self.rows)):
+            if simboard.level(self.rows[r]) == 0:
+                lowRows |= 1 << r
+        lowCols = -1
+        cols = 0
+        while cols != lowCols:
+            lowCols = cols
+            for r in range(len(self.rows)):
+                if self._keys[r] & cols:
+                    lowRows |= 1 << r
+                if lowRows & (1 << r):
+                    cols |= self._keys[r]
+        self._low = lowCols
+
+    def press(self, r, c):
+        self._keys[r] |= 1 << c
+        self._update()
+
+    def release(self, r, c):
+        self._keys[r] &= ~(1 << c)
+        self._update()
+
+    def releaseAll(self):
+        self._keys = [0]*len(self.rows)
+        self._update()
@@ -0,0 +1,128 @@
+# A fake I2C NavKey on the sim board: emulates the register map of the real thing.
+#
+# FakeNavKey([addr = 0x10], [intPin = None])
+# puts a navkey on the sim i2c bus at address addr. If intPin is not None, the INT line is
+# emulated on that pin (open drain, active low: low while STATUS & INTCONF is not zero).
+#
+# Methods:
+# press(key)/release(key): pushes/releases key (UP, DN, LT, RT, CTR as in i2cnavkey)
+# rotate(n): turns the encoder n detents (n<0: the other way)
+# reg(mem, n): reads n bytes at mem without any side effect
+# @property counter: the counter value (signed 32 bits)
+# offline: if True, the device does not acknowledge anything (unplugged cable...)
+#
+# Registers that matter: GCONF (0x00, reset and wrap bits), INTCONF (0x04-0x05), STATUS
+# (0x06-0x07, cleared when read), CVAL (0x0A), CMAX (0x0E), CMIN (0x12), ISTEP (0x16).
+# Multi-byte registers are big endian, reads and writes auto increment the register address.
+import struct
+import simboard
+
+rGConf = 0x00
+rIntConf = 0x04
+rIStatus = 0x06
+rCVal = 0x0A
+rCMax = 0x0E
+rCMin = 0x12
+rIStep = 0x16
+
+fWrapE = 1<<1
+fDirE = 1<<2
+fReset = 1<<7
+
+# (released bit, pressed bit) for UP, DN, LT, RT, CTR
+_keyBits = [(0, 1), (2, 3), (6, 7), (4, 5), (8, 9)]
+fRInc = 1<<11
+fRDec = 1<<12
+fRMax = 1<<13
+fRMin = 1<<14
+
+class FakeNavKey(object):
+    def __init__(self, addr = 0x10, intPin = None):
+        self.addr = addr
+        self.intPin = intPin
+        self.offline = False
+        self.resets = 0
+        self.regs = bytearray(256)
+        self._reset()
+        simboard.i2cDevices[addr] = self
+
+    def _reset(self):
+        self.regs[:] = bytes(256)
+        self.resets += 1
+        self._updateInt()
+
+    def _get32(self, mem):
+        return struct.unpack_from(">i", self.regs, mem)[0]
+
+    def _set32(self, mem, v):
+        v = ((v+(1<<31)) & 0xFFFFFFFF)-(1<<31)
+        struct.pack_into(">i", self.regs, mem, v)
+
+    @property
+    def status(self):
+        return (self.regs[rIStatus]<<8) | self.regs[rIStatus+1]
+
+    def _setStatus(self, bits):
+        st = self.status | bits
+        self.regs[rIStatus] = (st>>8) & 0xFF
+        self.regs[rIStatus+1] = st & 0xFF
+        self._updateInt()
+
+    def _updateInt(self):
+        if self.intPin is None:
+            return
+        intConf = (self.regs[rIntConf]<<8) | self.regs[rIntConf+1]
+        simboard.setLevel(self.intPin, 0 if (self.status & intConf) else 1)
+
+    @property
+    def counter(self):
+        return self._get32(rCVal)
+
+    def reg(self, mem, n):
+        return bytes(self.regs[mem:mem+n])
+
+    def read(self, mem, n):
+        data = self.reg(mem, n)
+        if mem <= rIStatus+1 and mem+n > rIStatus:
+            self.regs[rIStatus] = 0
+            self.regs[rIStatus+1] = 0
+            self._updateInt()
+        return data
+
+    def write(self, mem, data):
+        if mem == rGConf and data and data[0] & fReset:
+            self._reset()
+            return
+        self.regs[mem:mem+len(data)] = data
+        self._updateInt()
+
+    def press(self, key):
+        self._setStatus(1<<_keyBits[key][1])
+
+    def release(self, key):
+        self._setStatus(1<<_keyBits[key][0])
+
+    def rotate(self, n):
+        step = self._get32(rIStep)
+        cmax = self._get32(rCMax)
+        cmin = self._get32(rCMin)
+        wrap = self.regs[rGConf] & fWrapE
+        if self.regs[rGConf] & fDirE:
+            n = -n
+        for i in range(abs(n)):
+            v = self._get32(rCVal)
+            bits = 0
+            if n > 0:
+                v += step
+                bits |= fRInc
+                if v > cmax:
+                    bits |= fRMax
+                    v = cmin if wrap else cmax
+            else:
+                v -= step
+                bits |= fRDec
+                if v < cmin:
+                    bits |= fRMin
+                    v = cmax if wrap else cmin
+            self._set32(rCVal, v)
+            self._setStatus(bits)
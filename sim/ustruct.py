@@ -0,0 +1,2 @@
+# Host stand-in for microPython's ustruct.
+from struct import calcsize, pack, pack_into, unpack, unpack_from
@@ -0,0 +1,58 @@
+# Host stand-in for microPython's utime.
+#
+# The clock is virtual: it only moves when something advances it (sleep_us, the fake i2c bus,
+# the scenario runner...). This keeps every run of a scenario deterministic.
+#
+# Extra (sim only) functions:
+# simAdvance(us): moves the virtual clock forward by us microseconds
+# simNow(): the virtual time in microseconds, without wrap around
+# simReset(): back to time 0
+import time as _time
+
+TICKS_PERIOD = 1<<30
+TICKS_MAX = TICKS_PERIOD-1
+TICKS_HALFPERIOD = TICKS_PERIOD//2
+
+_now = 0
+
+def simAdvance(us):
+    global _now
+    if us>0:
+        _now += int(us)
+
+def simNow():
+    return _now
+
+def simReset():
+    global _now
+    _now = 0
+
+def ticks_us():
+    return _now & TICKS_MAX
+
+def ticks_ms():
+    return (_now//1000) & TICKS_MAX
+
+def ticks_cpu():
+    return ticks_us()
+
+def ticks_diff(t1, t0):
+    return ((t1-t0+TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+def ticks_add(t, delta):
+    return (t+delta) & TICKS_MAX
+
+def sleep_us(us):
+    simAdvance(us)
+
+def sleep_ms(ms):
+    simAdvance(ms*1000)
+
+def sleep(s):
+    simAdvance(s*1000000)
+
+def time():
+    return _now//1000000
+
+def localtime(secs = None):
+    return _time.gmtime(secs)[:8]